@@ -1,22 +1,210 @@
 # import needed modules
+import collections
+import time
 import serial
 
 
+class SCPIFrameReader:
+    """
+        Terminator-aware reader for a serial port
+        keeps one receive buffer per port and splits it into complete frames, so
+        several responses arriving in a single OS read are all kept for later calls
+    """
+
+    def __init__(self, port: serial.Serial, terminator=b'\r\n'):
+        self._port = port
+        self._term = terminator
+        self._buf = bytearray()
+        self._frames = collections.deque()
+
+    def _fill(self):
+        """
+            do one OS read: take whatever is waiting, or block for at most the port
+            timeout on the first byte and then take the rest that arrived with it
+        """
+        n = self._port.in_waiting
+        if n > 0:
+            data = self._port.read(n)
+        else:
+            data = self._port.read(1)
+            if data:
+                n = self._port.in_waiting
+                if n > 0:
+                    data += self._port.read(n)
+        if data:
+            self._buf.extend(data)
+            self._split()
+
+    def _split(self):
+        """
+            move every complete frame out of the receive buffer
+        """
+        buf = self._buf
+        term = self._term
+        start = 0
+        while True:
+            x = buf.find(term, start)
+            if x < 0:
+                break
+            self._frames.append(bytes(buf[start:x]))
+            start = x + len(term)
+        if start:
+            del buf[:start]
+
+    def pending(self) -> int:
+        """
+            number of complete frames already received but not yet returned
+        """
+        return len(self._frames)
+
+    def read_frame(self, timeout):
+        """
+            return the next complete frame (without terminator), or None if no
+            frame completed before the deadline. A partial frame left at the
+            deadline is dropped so the next query starts in sync
+        """
+        frames = self._frames
+        if not frames:
+            deadline = time.monotonic() + timeout
+            while not frames:
+                if time.monotonic() >= deadline:
+                    self._buf.clear()
+                    return None
+                self._fill()
+        return frames.popleft()
+
+    def read_frames(self, count, timeout) -> list:
+        """
+            return up to count frames sharing a single deadline
+        """
+        res = []
+        deadline = time.monotonic() + timeout
+        while len(res) < count:
+            frame = self.read_frame(max(deadline - time.monotonic(), 0))
+            if frame is None:
+                break
+            res.append(frame)
+        return res
+
+    def reset(self):
+        """
+            drop any buffered data, both ours and the driver's
+        """
+        self._buf.clear()
+        self._frames.clear()
+        self._port.reset_input_buffer()
+
+
+class SCPITransaction:
+    """
+        Queue several commands and queries, write them to the instrument in one burst
+        and demultiplex the responses in order
+        joined=True sends everything as one ';' separated line (for instruments that
+        accept it) and expects the responses back as one ';' separated line
+        use as a context manager (executes on exit) or call execute()
+        lock (if given) is held for the whole write + read exchange
+    """
+
+    def __init__(self, write, reader: SCPIFrameReader, timeout, joined=False, lock=None):
+        self._write = write
+        self._reader = reader
+        self.timeout = timeout
+        self.joined = joined
+        self.lock = lock
+        self._cmds = []
+        self._parsers = []  # one per query, in order
+        self.results = None
+
+    @staticmethod
+    def _to_bytes(cmd):
+        if isinstance(cmd, str):
+            cmd = cmd.encode('ascii')
+        return bytes(cmd).rstrip(b'\r\n')
+
+    def write(self, cmd):
+        """
+            queue a command that has no response
+        """
+        self._cmds.append(self._to_bytes(cmd))
+        return self
+
+    def query(self, cmd, parse=None) -> int:
+        """
+            queue a query, parse (if given) is applied to its decoded response
+            returns the index of the result in execute()'s list
+        """
+        self._cmds.append(self._to_bytes(cmd))
+        self._parsers.append(parse)
+        return len(self._parsers) - 1
+
+    def execute(self) -> list:
+        """
+            send everything queued and return one result per query
+            raises TimeoutError if not every query got its response, the replies
+            can't be matched to their queries then
+        """
+        cmds, parsers = self._cmds, self._parsers
+        self._cmds = []
+        self._parsers = []
+        if self.lock is not None:
+            with self.lock:
+                responses = self._exchange(cmds, len(parsers))
+        else:
+            responses = self._exchange(cmds, len(parsers))
+
+        results = []
+        for resp, parse in zip(responses, parsers):
+            res = resp.decode(errors="backslashreplace").strip()
+            results.append(parse(res) if parse else res)
+        self.results = results
+        return results
+
+    def _exchange(self, cmds, count):
+        # drop anything left over from an earlier exchange so responses line up with queries
+        self._reader.reset()
+        if self.joined:
+            self._write(b';'.join(cmds) + b'\n')
+        else:
+            self._write(b''.join(cmd + b'\n' for cmd in cmds))
+
+        if count == 0:
+            return []
+        if self.joined:
+            frame = self._reader.read_frame(self.timeout)
+            responses = [] if frame is None else frame.split(b';')
+        else:
+            responses = self._reader.read_frames(count, self.timeout)
+        if len(responses) != count:
+            # late replies would otherwise be read as answers to the next exchange
+            self._reader.reset()
+            raise TimeoutError(f"SCPI transaction: got {len(responses)} of {count} responses")
+        return responses
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.execute()
+
+
 class SCPI:
     """
         Serial SCPI interface
     """
     _SIF: serial.Serial
 
-    def __init__(self, port_dev, speed, timeout=2):
+    def __init__(self, port_dev, speed, timeout=2, poll_interval=0.05):
         self._SIF = None
+        self.timeout = timeout  # deadline for one complete response
         self._SIF = serial.Serial(
             port=port_dev,
             baudrate=speed,
             bytesize=8,
             parity='N',
             stopbits=1,
-            timeout=timeout)
+            timeout=min(timeout, poll_interval))
+        self._reader = SCPIFrameReader(self._SIF, b'\r\n')
 
     def __del__(self):
         # try:
@@ -25,41 +213,47 @@ class SCPI:
         #     pass
         self._SIF.close()
 
+    @staticmethod
+    def _decode(frame):
+        # any no-UTF8 characters are replaced by backslash-hex code
+        return frame.decode(errors="backslashreplace").strip()
+
     def readdata(self):
         """
             read a SCPI response from the serial port terminated by CR LF
             any no-UTF8 characters are replaced by backslash-hex code
+            returns '' if no complete response arrived within the timeout
         """
-        buf = bytearray(0)
-        n = 0
-        while True:
-            data = self._SIF.read(64)
-            if len(data) > 0:
-                buf.extend(data)
-                if len(buf) >= 2:
-                    if buf[-2:] == b'\r\n':
-                        break
-            else:
-                n = n + 1
-                if n > 2:
-                    buf = bytearray(0)
-                    break;
-
-        # for b in buf: print(hex(b)+' ',end='')
-        # print()
-        res = buf.decode(errors="backslashreplace")
-        x = res.find('\r\n')
-        if x == len(res) - 2:
-            res = res.strip()
-        else:
-            res = ''
+        frame = self._reader.read_frame(self.timeout)
+        if frame is None:
+            return ''
+        return self._decode(frame)
+
+    def readmany(self, count):
+        """
+            read count SCPI responses with a single deadline for all of them
+            missing responses are returned as ''
+        """
+        frames = self._reader.read_frames(count, self.timeout)
+        res = [self._decode(frame) for frame in frames]
+        res.extend([''] * (count - len(res)))
         return res
 
+    def transaction(self, joined=False) -> SCPITransaction:
+        """
+            start a pipelined transaction, see SCPITransaction
+        """
+        return SCPITransaction(self._SIF.write, self._reader, self.timeout, joined)
+
     def sendcmd(self, msg, getdata=True):
         """
             send a command over SCPI. If getdata is True, it waits for
             the response and returns it
         """
+        if getdata:
+            # drop frames left over from a late or unrequested reply, otherwise every
+            # later query would get the answer meant for the one before it
+            self._reader.reset()
         msg = msg + '\n'
         self._SIF.write(msg.encode('ascii'))
         if getdata:
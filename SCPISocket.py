@@ -0,0 +1,109 @@
+# import needed modules
+import collections
+import socket
+import time
+
+
+class SCPISocket:
+    """
+        Raw TCP socket SCPI transport (the "port 5025" style LAN interface)
+        exposes the same write/read/query/timeout/termination interface as a pyvisa
+        resource so it can be used in place of one, without the pyvisa overhead
+        Nagle is disabled, several commands can be sent in one segment with write_many()
+        and responses are split out of one reusable receive buffer
+    """
+    SCHEME = "socket://"
+    DEFAULT_PORT = 5025
+
+    def __init__(self, host, port=DEFAULT_PORT, timeout=1000, bufsize=65536):
+        self.host = host
+        self.port = port
+        self.timeout = timeout  # ms per response, like pyvisa
+        self.write_termination = '\n'
+        self.read_termination = '\n'
+        self._sock = socket.create_connection((host, port), timeout=timeout / 1000)
+        self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._rxbuf = bytearray(bufsize)
+        self._rxview = memoryview(self._rxbuf)
+        self._pending = bytearray()  # received bytes not yet split into frames
+        self._frames = collections.deque()
+
+    @classmethod
+    def is_address(cls, address) -> bool:
+        return address.startswith(cls.SCHEME)
+
+    @classmethod
+    def from_address(cls, address, timeout=1000):
+        """
+            open 'socket://host' or 'socket://host:port'
+        """
+        hostport = address[len(cls.SCHEME):].rstrip('/')
+        host, sep, port = hostport.rpartition(':')
+        if not sep or not port.isdigit():
+            return cls(hostport, cls.DEFAULT_PORT, timeout)
+        return cls(host, int(port), timeout)
+
+    def write(self, cmd):
+        self._sock.sendall((cmd + self.write_termination).encode('ascii'))
+
+    def write_many(self, cmds):
+        """
+            send several commands in one burst
+        """
+        term = self.write_termination
+        self._sock.sendall(''.join(cmd + term for cmd in cmds).encode('ascii'))
+
+    def _split(self):
+        term = self.read_termination.encode('ascii')
+        buf = self._pending
+        start = 0
+        while True:
+            x = buf.find(term, start)
+            if x < 0:
+                break
+            self._frames.append(bytes(buf[start:x]))
+            start = x + len(term)
+        if start:
+            del buf[:start]
+
+    def read(self) -> str:
+        """
+            return the next response (without terminator), raises socket.timeout if it
+            doesn't arrive within self.timeout ms
+        """
+        frames = self._frames
+        if not frames:
+            deadline = time.monotonic() + self.timeout / 1000
+            try:
+                while not frames:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise socket.timeout(f"No response from {self.host}:{self.port} within {self.timeout} ms")
+                    self._sock.settimeout(remaining)
+                    n = self._sock.recv_into(self._rxview)
+                    if n == 0:
+                        raise ConnectionError(f"{self.host}:{self.port} closed the connection")
+                    self._pending += self._rxview[:n]
+                    self._split()
+            finally:
+                # the shrunk receive timeout would otherwise also apply to the next sendall
+                self._sock.settimeout(self.timeout / 1000)
+        return frames.popleft().decode(errors="backslashreplace").rstrip('\r')
+
+    def query(self, cmd) -> str:
+        self.write(cmd)
+        return self.read()
+
+    def query_many(self, cmds) -> list:
+        """
+            pipelined queries: one burst out, responses read back in order
+        """
+        self.write_many(cmds)
+        return [self.read() for _ in cmds]
+
+    def close(self):
+        try:
+            self._sock.close()
+        finally:
+            self._pending.clear()
+            self._frames.clear()
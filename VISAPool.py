@@ -0,0 +1,180 @@
+# import needed modules
+import atexit
+import collections
+import contextlib
+import threading
+from pyvisa import ResourceManager
+import pyvisa.errors
+
+# import user created modules
+from EEequipment.SCPISocket import SCPISocket
+
+
+class PriorityRLock:
+    """
+        Reentrant lock that hands the lock out in arrival order, with urgent acquirers (e.g. a
+        safety interlock turning an output off) served before every normal waiter, so they only
+        wait for the exchange that is already on the bus and not for everything queued behind it
+        FIFO also means a thread polling in a tight loop can't starve the others
+        Drop-in for threading.RLock: acquire/release and use with `with`
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._owner = None
+        self._count = 0
+        self._waiting = collections.deque()  # normal waiters in arrival order
+        self._urgent = collections.deque()
+
+    def acquire(self, blocking=True, timeout=-1, urgent=False):
+        me = threading.get_ident()
+        with self._cond:
+            if self._owner == me:
+                self._count += 1
+                return True
+            if not blocking:
+                if self._owner is not None or self._urgent or self._waiting:
+                    return False
+                self._owner = me
+                self._count = 1
+                return True
+
+            queue = self._urgent if urgent else self._waiting
+            token = object()
+            queue.append(token)
+
+            def my_turn():
+                if self._owner is not None or queue[0] is not token:
+                    return False
+                return urgent or not self._urgent
+
+            ok = self._cond.wait_for(my_turn, None if timeout < 0 else timeout)
+            queue.remove(token)
+            if ok:
+                self._owner = me
+                self._count = 1
+            else:
+                self._cond.notify_all()
+            return ok
+
+    def release(self):
+        with self._cond:
+            if self._owner != threading.get_ident():
+                raise RuntimeError("cannot release un-acquired lock")
+            self._count -= 1
+            if self._count == 0:
+                self._owner = None
+                self._cond.notify_all()
+
+    @contextlib.contextmanager
+    def urgent(self):
+        self.acquire(urgent=True)
+        try:
+            yield self
+        finally:
+            self.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+
+class VISASession:
+    """
+        One open VISA resource shared by every instrument object using the same address
+        'socket://host[:port]' addresses get a raw SCPISocket instead of a pyvisa resource
+        state is a scratch dict the instrument classes use to remember what they know about
+        the instrument (e.g. output state) between objects, it is cleared on reconnect
+    """
+
+    def __init__(self, pool, address, configure=None):
+        self.pool = pool
+        self.address = address
+        self.configure = configure
+        self.resource = None
+        self.refcount = 0
+        self.state = {}
+        self.lock = PriorityRLock()  # one exchange at a time across all users of the session
+        self.open()
+
+    def open(self):
+        if SCPISocket.is_address(self.address):
+            self.resource = SCPISocket.from_address(self.address)
+        else:
+            self.resource = self.pool.resource_manager().open_resource(self.address)
+        if self.configure is not None:
+            self.configure(self.resource)
+
+    def close(self):
+        if self.resource is not None:
+            try:
+                self.resource.close()
+            except (pyvisa.errors.Error, OSError):
+                pass
+            self.resource = None
+
+    def reconnect(self):
+        """
+            close and reopen the resource after an I/O error, the cached state is forgotten
+        """
+        with self.lock:
+            self.close()
+            self.state.clear()
+            self.open()
+
+
+class VISASessionPool:
+    """
+        Process-wide pool of VISA sessions keyed by resource address
+        one ResourceManager is shared by all sessions and sessions stay open after the last
+        user releases them (keep_idle) so the next object for that address attaches instantly
+    """
+
+    def __init__(self, backend='@py', keep_idle=True):
+        self.backend = backend
+        self.keep_idle = keep_idle
+        self._rm = None
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def resource_manager(self):
+        if self._rm is None:
+            try:
+                self._rm = ResourceManager(self.backend)  # use 'pyvisa-py' backend by default
+            except ValueError:
+                self._rm = ResourceManager()
+        return self._rm
+
+    def acquire(self, address, configure=None):
+        """
+            return (session, reused) for address, opening it if needed
+            configure(resource) is called on every (re)open to set terminations/timeouts
+        """
+        with self._lock:
+            session = self._sessions.get(address)
+            reused = session is not None and session.resource is not None
+            if not reused:
+                session = VISASession(self, address, configure)
+                self._sessions[address] = session
+            session.refcount += 1
+            return session, reused
+
+    def release(self, session):
+        with self._lock:
+            session.refcount = max(session.refcount - 1, 0)
+            if session.refcount == 0 and not self.keep_idle:
+                session.close()
+                self._sessions.pop(session.address, None)
+
+    def close_all(self):
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions.clear()
+
+
+pool = VISASessionPool()
+atexit.register(pool.close_all)
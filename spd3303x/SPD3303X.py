@@ -1,13 +1,32 @@
 
 
 # import needed modules
-from pyvisa import ResourceManager
+import collections
+import contextlib
+import time
+import types
+import numpy as np
 import pyvisa.errors
 import usb
 import configparser
 
 # import Equipment parent class
 from EEequipment.Equipment import Equipment
+from EEequipment import VISAPool
+from EEequipment.SCPISocket import SCPISocket
+
+
+# one reading of both channels, power is V * I (calibrated current), status is the decoded SYSTem:STATus?
+SPD3303XSnapshot = collections.namedtuple(
+    "SPD3303XSnapshot",
+    ["t", "voltage", "current", "power", "status_raw", "status"])
+
+SNAPSHOT_DTYPE = np.dtype([
+    ("t", np.float64),
+    ("ch1_v", np.float64), ("ch1_i", np.float64), ("ch1_p", np.float64),
+    ("ch2_v", np.float64), ("ch2_i", np.float64), ("ch2_p", np.float64),
+    ("status", np.uint16),
+])
 
 
 class SPD3303X(Equipment):
@@ -20,12 +39,15 @@ class SPD3303X(Equipment):
         Exception raised when a call returns an error message
         '''
 
-        def __init__(self, code, message):
+        def __init__(self, code, message, command=None):
             self.code = code
             self.message = message
+            self.command = command  # the command that caused it, if known
             super().__init__(self.message)
 
         def __str__(self):
+            if self.command is not None:
+                return f'Error Code: {self.code} -> {self.message} (command: {self.command})'
             return f'Error Code: {self.code} -> {self.message}'
 
     ch1_v_m = None
@@ -36,42 +58,89 @@ class SPD3303X(Equipment):
     ch2_i_b = None
     channel_count = 2
     save_file_count = 5
+    timer_group_count = 5
+    timer_resolution = 1  # s, smallest TIMEr:SET time step
     INDEPENDENT_MODE = 0
     SERIES_MODE = 1
     PARALLEL_MODE = 2
+    ERROR_CHECK_IMMEDIATE = 0  # SYSTem:ERRor? after every write
+    ERROR_CHECK_DEFERRED = 1  # one drain of the error queue at the end of a batch()
+    ERROR_CHECK_SAMPLED = 2  # drain every error_sample_every writes
+    error_queue_depth = 20
+    # write several queries before reading the responses back, only if the transport allows
+    # it (USBTMC reports "query interrupted" for a write with a response still unread)
+    pipeline_queries = False
     manufacturer = ""
     product_type = ""
     series_number = ""
     software_version = ""
     hardware_version = ""
 
-    def __init__(self, instadd):
+    def __init__(self, instadd, fast_attach=True, pool=None):
         '''
         Init the VISA (pyvisa) connection and get the basic product info
+        An address of the form 'socket://host[:port]' uses the raw TCP transport (SCPISocket,
+        port 5025 by default) instead of pyvisa, with pipelined queries enabled
+        The session comes from a process-wide pool (VISAPool.pool), so creating the object again
+        for the same address reuses the open connection. With fast_attach the safety zeroing is
+        skipped when the reused session already knows the output state
         '''
         super().__init__()
         self._load_cal()
+        self._pool = pool if pool is not None else VISAPool.pool
+        self._session = None
+        if SCPISocket.is_address(instadd):
+            self.pipeline_queries = True
 
-        # set up the ResourceManager
-        try:
-            rm = ResourceManager('@py')  # use 'pyvisa-py' backend
-        except ValueError:
-            rm = ResourceManager()
+        # error checking policy for __send_cmd
+        self.error_policy = self.ERROR_CHECK_IMMEDIATE
+        self.error_sample_every = 10
+        self.replay_on_error = True
+        self._unchecked_cmds = []
 
         # attempt to open instance
         try:
-            self.inst = rm.open_resource(instadd)
-            self.inst.write_termination = '\n'
-            self.inst.read_termination = '\n'
-            self.inst.timeout = 1 * 1000  # NOTE: used to be 2 seconds
+            self._session, reused = self._pool.acquire(instadd, self._configure_inst)
+            known = self._session.state.get("outputs", {})
+            if reused and fast_attach and len(known) == self.channel_count:
+                return
 
             # set default voltages on connect to 0V because I'm dumb and burn my boards too often
-            self.set_voltage(1, 0)
-            self.set_voltage(2, 0)
-        except (usb.core.USBError, pyvisa.errors.VisaIOError) as e:
+            with self.batch():
+                self.set_voltage(1, 0, force=True)
+                self.set_voltage(2, 0, force=True)
+            status = self.check_status()
+            self._session.state["outputs"] = {1: status["ch1_state"] == "ON", 2: status["ch2_state"] == "ON"}
+        except (usb.core.USBError, pyvisa.errors.VisaIOError, OSError) as e:
             print("Error with opening SPD3303X")
             print(e)
 
+    @staticmethod
+    def _configure_inst(inst):
+        inst.write_termination = '\n'
+        inst.read_termination = '\n'
+        inst.timeout = 1 * 1000  # NOTE: used to be 2 seconds
+
+    @property
+    def inst(self):
+        return self._session.resource if self._session is not None else None
+
+    @property
+    def lock(self):
+        # one write/read exchange on the bus at a time, shared by every object on this session
+        return self._session.lock
+
+    def _io(self, fn):
+        '''
+        Run an I/O call, on a VISA I/O error (or socket error) reconnect the session once and retry
+        '''
+        try:
+            return fn()
+        except (pyvisa.errors.VisaIOError, OSError):
+            print(f"SPD3303X: I/O error, reconnecting {self._session.address}")
+            self._session.reconnect()
+            return fn()
+
     def _load_cal(self):
         # initialize the config parser
         config_file_path = "./EEequipment/spd3303x/config.ini"
@@ -87,6 +156,21 @@ class SPD3303X(Equipment):
         self.ch2_v_b = float(config["CH2"]["v_offset"])
         self.ch2_i_b = float(config["CH2"]["i_offset"])
 
+        # a swept calibration (see calibration.py) replaces the linear one per channel
+        from EEequipment.spd3303x import calibration
+        self._corrections = calibration.load_calibration()
+        if self._corrections:
+            print(f"SPD3303X: using swept voltage calibration for CH{', CH'.join(str(ch) for ch in sorted(self._corrections))}")
+
+    def set_calibration(self, corrections):
+        '''
+        Use {channel: VoltageCorrection} from calibration.py in place of the config.ini slope/offset,
+        an empty dict goes back to the linear calibration
+        '''
+        self._corrections = dict(corrections)
+        # setpoints in the shadow were corrected with the old calibration
+        self._shadow("voltage").clear()
+
     def test_conn(self):
         print("SPD3303X: issuing IDN? command")
         try:
@@ -99,15 +183,17 @@ class SPD3303X(Equipment):
 
     def close(self):
         '''
-        Close the socket connection
+        Release the connection, the pool keeps the session open for the next user
         '''
-        self.inst.close()
+        if self._session is not None:
+            self._pool.release(self._session)
+            self._session = None
 
     def __get_product_info(self):
         '''
         Query the manufacturer, product type, series, series no., software version, hardware version
         '''
-        idn = self.inst.query('*IDN?')
+        idn = self._query('*IDN?')
 
         # NOTE: can't uncomment below code because my equipment simply returns 'Siglent Techno' from query
         # resp_arr = idn.split(",")
@@ -120,10 +206,86 @@ class SPD3303X(Equipment):
 
     def __send_cmd(self, cmd):
         '''
-        Generic call to send command with error checking
+        Generic call to send command with error checking according to error_policy
+        '''
+        with self.lock:
+            self._io(lambda: self.inst.write(cmd))
+            if self.error_policy == self.ERROR_CHECK_IMMEDIATE:
+                self.check_error()
+                return
+            self._unchecked_cmds.append(cmd)
+            if self.error_policy == self.ERROR_CHECK_SAMPLED and len(self._unchecked_cmds) >= self.error_sample_every:
+                self.flush_errors()
+
+    def _write(self, cmd):
+        '''
+        Write a command that has no response
+        '''
+        with self.lock:
+            self._io(lambda: self.inst.write(cmd))
+
+    def _query(self, cmd):
         '''
-        self.inst.write(cmd)
-        self.check_error()
+        Write a query and read its response as one exchange
+        '''
+        def exchange():
+            self.inst.write(cmd)
+            return self.inst.read()
+
+        with self.lock:
+            return self._io(exchange)
+
+    @contextlib.contextmanager
+    def batch(self):
+        '''
+        Defer error checking of the writes inside the with block to a single drain of the
+        error queue on exit, e.g. programming both channels' limits costs one SYSTem:ERRor?
+        '''
+        prev_policy = self.error_policy
+        if prev_policy == self.ERROR_CHECK_DEFERRED:
+            # nested batch, the outer one does the check
+            yield self
+            return
+        self.error_policy = self.ERROR_CHECK_DEFERRED
+        try:
+            yield self
+        except BaseException:
+            self.error_policy = prev_policy
+            self._unchecked_cmds = []
+            raise
+        self.error_policy = prev_policy
+        self.flush_errors()
+
+    def flush_errors(self):
+        '''
+        Drain the whole error queue for the writes sent since the last check.
+        Raises SPD3303Exception naming the failing command. With more than one write pending
+        the failing one is found by replaying the writes with immediate checking (setpoint
+        writes are idempotent), unless replay_on_error is False
+        '''
+        cmds = self._unchecked_cmds
+        self._unchecked_cmds = []
+        errors = []
+        for _ in range(self.error_queue_depth):
+            error = self._read_error()
+            if error is None:
+                break
+            errors.append(error)
+        if not errors:
+            return False
+
+        # some write in the batch didn't take, the shadow can't be trusted anymore
+        self.invalidate_state()
+        if len(cmds) == 1:
+            raise self.SPD3303Exception(errors[0][0], errors[0][1], cmds[0])
+        if self.replay_on_error:
+            with self.lock:
+                for cmd in cmds:
+                    self.inst.write(cmd)
+                    error = self._read_error()
+                    if error is not None:
+                        raise self.SPD3303Exception(error[0], error[1], cmd)
+        raise self.SPD3303Exception(errors[0][0], f'{errors[0][1]} ({len(errors)} error(s) in batch)', cmds)
 
     def save(self, file_num):
         '''
@@ -132,7 +294,7 @@ class SPD3303X(Equipment):
         if file_num not in range(1, self.save_file_count + 1):
             raise self.SPD3303Exception('20', f'Save file must be an integer 1 - {self.save_file_count}')
         else:
-            self.inst.write(f"*SAV {file_num}")
+            self._write(f"*SAV {file_num}")
 
     def recall(self, file_num):
         '''
@@ -141,7 +303,8 @@ class SPD3303X(Equipment):
         if file_num not in range(1, self.save_file_count + 1):
             raise self.SPD3303Exception('20', f'Save file must be an integer 1 - {self.save_file_count}')
         else:
-            self.inst.write(f"*RCL {file_num}")
+            self._write(f"*RCL {file_num}")
+            self.invalidate_state()
 
     def select_channel(self, channel):
         '''
@@ -150,65 +313,152 @@ class SPD3303X(Equipment):
         if channel not in range(1, self.channel_count + 1):
             raise self.SPD3303Exception('21', f'Channel # must be an integer 1 - {self.channel_count}')
         else:
-            self.inst.write(f"INSTrument CH{channel}")
+            self._write(f"INSTrument CH{channel}")
+
+    ##################################
+    #### shadow state  ###############
+    ##################################
+    def _shadow(self, key):
+        '''
+        Host side copy of what was last written to the instrument, kept in the pooled session so
+        every object on the same supply shares it. Missing entries mean unknown
+        '''
+        return self._session.state.setdefault(key, {})
+
+    # session state keys that only mirror setpoints, "outputs" stays: fast_attach relies on it
+    _shadow_keys = ("voltage", "current", "timers", "timer_groups", "track")
+
+    def invalidate_state(self):
+        '''
+        Forget the setpoint shadow, the next write of every setting goes to the instrument
+        '''
+        for key in self._shadow_keys:
+            self._session.state.pop(key, None)
+
+    def invalidate_setpoints(self, channel):
+        '''
+        Forget the voltage/current shadow of one channel, e.g. after the timer changed them
+        '''
+        self._shadow("voltage").pop(channel, None)
+        self._shadow("current").pop(channel, None)
+
+    def resync(self):
+        '''
+        Re-read setpoints, current limits, outputs, timers and tracking mode in one batch
+        Timer group parameters aren't read back (that's 10 queries), they are marked unknown
+        '''
+        cmds = []
+        for ch in range(1, self.channel_count + 1):
+            cmds.append(f"CH{ch}:VOLTage?")
+            cmds.append(f"CH{ch}:CURRent?")
+        cmds.append("SYSTem:STATus?")
+        resp = self.query_many(cmds)
+
+        self.invalidate_state()
+        voltage = self._shadow("voltage")
+        current = self._shadow("current")
+        for ch in range(1, self.channel_count + 1):
+            voltage[ch] = self._uncal_voltage(ch, float(resp[2 * ch - 2]))
+            current[ch] = float(resp[2 * ch - 1])
+
+        status = int(resp[-1], 16)
+        outputs = self._shadow("outputs")
+        timers = self._shadow("timers")
+        for ch in range(1, self.channel_count + 1):
+            outputs[ch] = bool(status & (0x10 << (ch - 1)))
+            timers[ch] = bool(status & (0x40 << (ch - 1)))
+        mode_bits = (status >> 2) & 0x03
+        if mode_bits == 0x01:
+            self._session.state["track"] = self.INDEPENDENT_MODE
+        elif mode_bits == 0x02:
+            self._session.state["track"] = self.PARALLEL_MODE
+
+    def _v_cal(self, channel):
+        if channel == 1:
+            return self.ch1_v_m, self.ch1_v_b
+        elif channel == 2:
+            return self.ch2_v_m, self.ch2_v_b
+
+    def _cal_voltage(self, channel, value):
+        # do some calibration correction (because Siglent makes a shitty product that is a pain to calibrate)
+        corr = self._corrections.get(channel)
+        if corr is not None:
+            return round(float(corr.command(value)), 3)
+        slope, offset = self._v_cal(channel)
+        return round(value + value * slope + offset, 3)
+
+    def _uncal_voltage(self, channel, cal_value):
+        # inverse of _cal_voltage, for setpoints read back from the instrument
+        corr = self._corrections.get(channel)
+        if corr is not None:
+            return round(float(corr.wanted(cal_value)), 3) + 0.0
+        slope, offset = self._v_cal(channel)
+        return round((cal_value - offset) / (1 + slope), 3) + 0.0
 
     ##################################
     #### get/set functions  ##########
     ##################################
     def set_raw_voltage(self, channel, value):
         self.__send_cmd(f"CH{channel}:VOLTage {value}")
+        self._shadow("voltage")[channel] = self._uncal_voltage(channel, value)
 
-    def set_voltage(self, channel, value):
+    def set_voltage(self, channel, value, force=False):
         '''
-        Set the voltage value for the selected channel
+        Set the voltage value for the selected channel, skipped if it is already set
         '''
         if channel not in range(1, self.channel_count + 1):
             raise self.SPD3303Exception('21', f'Channel # must be an integer 1 - {self.channel_count}')
         else:
-            def get_ch_v_cal(ch):
-                if ch == 1:
-                    return self.ch2_v_m, self.ch2_v_b
-                elif ch == 2:
-                    return self.ch2_v_m, self.ch2_v_b
-
-            # do some calibration correction (because Siglent makes a shitty product that is a pain to calibrate)
-            slope, offset = get_ch_v_cal(channel)
-            cal_value = round(value + value * slope + offset, 3)
+            voltage = self._shadow("voltage")
+            if not force and voltage.get(channel) == value:
+                return
+            cal_value = self._cal_voltage(channel, value)
             self.__send_cmd(f"CH{channel}:VOLTage {cal_value}")
+            voltage[channel] = value
 
-    def set_current(self, channel, value):
+    def set_current(self, channel, value, force=False):
         '''
-        Set the current value for the selected channel
+        Set the current value for the selected channel, skipped if it is already set
         '''
         if channel not in range(1, self.channel_count + 1):
             raise self.SPD3303Exception('21', f'Channel # must be an integer 1 - {self.channel_count}')
         else:
+            current = self._shadow("current")
+            if not force and current.get(channel) == value:
+                return
             self.__send_cmd(f"CH{channel}:CURRent {value}")
+            current[channel] = value
 
     def get_set_voltage(self, channel):
         '''
-        Get the set voltage value of the channel
+        Get the set voltage value of the channel (before calibration correction), from the
+        shadow when known
         '''
         if channel not in range(1, self.channel_count + 1):
             raise self.SPD3303Exception('21', f'Channel # must be an integer 1 - {self.channel_count}')
         else:
-            self.inst.write(f"CH{channel}:VOLTage?")
+            voltage = self._shadow("voltage")
+            if channel not in voltage:
+                voltage[channel] = self._uncal_voltage(channel, float(self._query(f"CH{channel}:VOLTage?")))
+            return voltage[channel]
 
     def get_set_current(self, channel):
         '''
-        Get the set current value of the channel
+        Get the set current value of the channel, from the shadow when known
         '''
         if channel not in range(1, self.channel_count + 1):
             raise self.SPD3303Exception('21', f'Channel # must be an integer 1 - {self.channel_count}')
         else:
-            self.inst.write(f"CH{channel}:CURRent?")
+            current = self._shadow("current")
+            if channel not in current:
+                current[channel] = float(self._query(f"CH{channel}:CURRent?"))
+            return current[channel]
 
     def get_active_channel(self):
         '''
         Query for the active channel
         '''
-        self.inst.write("INSTrument?")
-        return self.inst.read()
+        return self._query("INSTrument?")
 
     def get_voltage(self, channel):
         '''
@@ -217,11 +467,10 @@ class SPD3303X(Equipment):
         if channel not in range(1, self.channel_count + 1):
             raise self.SPD3303Exception('21', f'Channel # must be an integer 1 - {self.channel_count}')
         else:
-            self.inst.write(f"MEASure:VOLTage? CH{channel}")
-            return float(self.inst.read())
+            return float(self._query(f"MEASure:VOLTage? CH{channel}"))
 
     def get_raw_current(self, channel):
-        raw_current = float(self.inst.query(f"MEASure:CURRent? CH{channel}"))
+        raw_current = float(self._query(f"MEASure:CURRent? CH{channel}"))
         return raw_current
 
     def get_current(self, channel):
@@ -231,7 +480,7 @@ class SPD3303X(Equipment):
         if channel not in range(1, self.channel_count + 1):
             raise self.SPD3303Exception('21', f'Channel # must be an integer 1 - {self.channel_count}')
         else:
-            raw_current = float(self.inst.query(f"MEASure:CURRent? CH{channel}"))
+            raw_current = float(self._query(f"MEASure:CURRent? CH{channel}"))
             if channel == 1:
                 return raw_current - self.ch1_i_b
             elif channel == 2:
@@ -244,33 +493,133 @@ class SPD3303X(Equipment):
         if channel not in range(1, self.channel_count + 1):
             raise self.SPD3303Exception('21', f'Channel # must be an integer 1 - {self.channel_count}')
         else:
-            self.inst.write(f"MEASure:POWEr? CH{channel}")
-            return float(self.inst.read())
+            return float(self._query(f"MEASure:POWEr? CH{channel}"))
+
+    def get_voltage_current(self, channel):
+        '''
+        Measured voltage and (offset corrected) current of a channel in one exchange
+        '''
+        if channel not in range(1, self.channel_count + 1):
+            raise self.SPD3303Exception('21', f'Channel # must be an integer 1 - {self.channel_count}')
+        resp = self.query_many([f"MEASure:VOLTage? CH{channel}", f"MEASure:CURRent? CH{channel}"])
+        i_offset = self.ch1_i_b if channel == 1 else self.ch2_i_b
+        return float(resp[0]), float(resp[1]) - i_offset
+
+    def query_many(self, cmds):
+        '''
+        Send several queries and return their responses in order, in one burst when
+        pipeline_queries is set, otherwise as back to back query() calls
+        '''
+        def exchange():
+            if hasattr(self.inst, "write_many"):
+                self.inst.write_many(cmds)
+            else:
+                for cmd in cmds:
+                    self.inst.write(cmd)
+            return [self.inst.read() for _ in cmds]
+
+        with self.lock:
+            if self.pipeline_queries:
+                return self._io(exchange)
+            return [self._query(cmd) for cmd in cmds]
+
+    _snapshot_cmds = [
+        "MEASure:VOLTage? CH1", "MEASure:CURRent? CH1",
+        "MEASure:VOLTage? CH2", "MEASure:CURRent? CH2",
+        "SYSTem:STATus?",
+    ]
+
+    def _snapshot_raw(self):
+        # voltage/current for both channels and the status word, power is derived host side
+        resp = self.query_many(self._snapshot_cmds)
+        t = time.monotonic()
+        return t, float(resp[0]), float(resp[1]), float(resp[2]), float(resp[3]), int(resp[4], 16)
+
+    def snapshot(self) -> SPD3303XSnapshot:
+        '''
+        Read voltage, current and power of both channels plus the status bits in the fewest
+        exchanges the instrument allows (power is computed as V * I instead of asking for it)
+        '''
+        t, v1, i1, v2, i2, status = self._snapshot_raw()
+        i1 -= self.ch1_i_b
+        i2 -= self.ch2_i_b
+        return SPD3303XSnapshot(
+            t,
+            (v1, v2),
+            (i1, i2),
+            (v1 * i1, v2 * i2),
+            status,
+            types.MappingProxyType(self._decode_hex(hex(status))))
+
+    def snapshots(self, n):
+        '''
+        Take n snapshots back to back into a NumPy structured array (SNAPSHOT_DTYPE),
+        calibration offsets and power are applied to the whole array at the end
+        '''
+        arr = np.zeros(n, dtype=SNAPSHOT_DTYPE)
+        for k in range(n):
+            t, v1, i1, v2, i2, status = self._snapshot_raw()
+            arr[k] = (t, v1, i1, 0.0, v2, i2, 0.0, status)
+        arr["ch1_i"] -= self.ch1_i_b
+        arr["ch2_i"] -= self.ch2_i_b
+        arr["ch1_p"] = arr["ch1_v"] * arr["ch1_i"]
+        arr["ch2_p"] = arr["ch2_v"] * arr["ch2_i"]
+        return arr
 
     ##################################
     #### control functions  ##########
     ##################################
-    def output_on(self, channel):
+    def output_on(self, channel, force=False):
         '''
         Turn on the channel output
         '''
         if channel not in range(1, self.channel_count + 1):
             raise self.SPD3303Exception('21', f'Channel # must be an integer 1 - {self.channel_count}')
         else:
-            self.inst.write(f"OUTPut CH{channel},ON")
+            outputs = self._shadow("outputs")
+            if not force and outputs.get(channel) is True:
+                return
+            self._write(f"OUTPut CH{channel},ON")
+            outputs[channel] = True
 
-    def output_off(self, channel):
+    def output_off(self, channel, force=False):
         '''
         Turn off the channel outputdo
         '''
         if channel not in range(1, self.channel_count + 1):
             raise self.SPD3303Exception('21', f'Channel # must be an integer 1 - {self.channel_count}')
         else:
-            self.inst.write(f"OUTPut CH{channel},OFF")
-
-    def set_operation_mode(self, mode):
+            outputs = self._shadow("outputs")
+            if not force and outputs.get(channel) is False:
+                return
+            self._write(f"OUTPut CH{channel},OFF")
+            outputs[channel] = False
+
+    def emergency_off(self, channels=None):
+        '''
+        Turn outputs off through the urgent side of the session lock, ahead of any queued
+        commands and without the error check round trip. Returns the time the write went out
+        '''
+        channels = range(1, self.channel_count + 1) if channels is None else channels
+        lines = [f"OUTPut CH{channel},OFF" for channel in channels]
+        with self.lock.urgent():
+            if hasattr(self.inst, "write_many"):
+                self._io(lambda: self.inst.write_many(lines))
+            else:
+                for line in lines:
+                    self._io(lambda: self.inst.write(line))
+            t_off = time.monotonic()
+            outputs = self._shadow("outputs")
+            for channel in channels:
+                outputs[channel] = False
+        return t_off
+
+    def set_operation_mode(self, mode, force=False):
         if mode == 0 or mode == 1 or mode == 2:
-            self.inst.write(f"OUTPut:TRACK {mode}")
+            if not force and self._session.state.get("track") == mode:
+                return
+            self._write(f"OUTPut:TRACK {mode}")
+            self._session.state["track"] = mode
         else:
             raise self.SPD3303Exception('22', f'Invalid Operation Mode')
 
@@ -290,16 +639,20 @@ class SPD3303X(Equipment):
         if channel not in range(1, self.channel_count + 1):
             raise self.SPD3303Exception('21', f'Channel # must be an integer 1 - {self.channel_count}')
         else:
-            self.inst.write(f"OUTPut:WAVE CH{channel},OFF")
+            self._write(f"OUTPut:WAVE CH{channel},OFF")
 
-    def set_timing_parameters(self, channel, group, voltage, current, time):
+    def set_timing_parameters(self, channel, group, voltage, current, time, force=False):
         '''
         Set the timing parameters of specified channel, group setting the voltage current and execution time
         '''
         if channel not in range(1, self.channel_count + 1):
             raise self.SPD3303Exception('21', f'Channel # must be an integer 1 - {self.channel_count}')
         else:
-            self.inst.write(f"TIMEr:SET CH{channel},{group},{voltage},{current},{time}")
+            groups = self._shadow("timer_groups")
+            if not force and groups.get((channel, group)) == (voltage, current, time):
+                return
+            self._write(f"TIMEr:SET CH{channel},{group},{voltage},{current},{time}")
+            groups[(channel, group)] = (voltage, current, time)
 
     def query_timing_parameters(self, channel, group):
         '''
@@ -308,53 +661,104 @@ class SPD3303X(Equipment):
         if channel not in range(1, self.channel_count + 1):
             raise self.SPD3303Exception('21', f'Channel # must be an integer 1 - {self.channel_count}')
         else:
-            self.inst.write(f"TIMEr:SET? CH{channel},{group}")
-            response = self.inst.read()
+            response = self._query(f"TIMEr:SET? CH{channel},{group}")
             resp_arr = response.split(",")
             return (resp_arr[0], (resp_arr[1], resp_arr[2]))
 
-    def turn_on_timer(self, channel):
+    def turn_on_timer(self, channel, force=False):
         '''
         Turn on timer function of specific channel
         '''
         if channel not in range(1, self.channel_count + 1):
             raise self.SPD3303Exception('21', f'Channel # must be an integer 1 - {self.channel_count}')
         else:
-            self.inst.write(f"TIMEr CH{channel},ON")
+            timers = self._shadow("timers")
+            if not force and timers.get(channel) is True:
+                return
+            self._write(f"TIMEr CH{channel},ON")
+            timers[channel] = True
 
-    def turn_off_timer(self, channel):
+    def turn_off_timer(self, channel, force=False):
         '''
         Turn off timer fuction of specific channel
         '''
         if channel not in range(1, self.channel_count + 1):
             raise self.SPD3303Exception('21', f'Channel # must be an integer 1 - {self.channel_count}')
         else:
-            self.inst.write(f"TIMEr CH{channel},OFF")
+            timers = self._shadow("timers")
+            if not force and timers.get(channel) is False:
+                return
+            self._write(f"TIMEr CH{channel},OFF")
+            timers[channel] = False
+
+    def upload_timer_groups(self, channel, groups):
+        '''
+        Program all timer groups of a channel in one burst followed by one error check
+        groups is a list of (voltage, current, time), voltages are calibration corrected here,
+        groups past the end of the list are set to time 0
+        '''
+        if channel not in range(1, self.channel_count + 1):
+            raise self.SPD3303Exception('21', f'Channel # must be an integer 1 - {self.channel_count}')
+        if len(groups) > self.timer_group_count:
+            raise self.SPD3303Exception('23', f'At most {self.timer_group_count} timer groups per channel')
+
+        shadow = self._shadow("timer_groups")
+        cmds = []
+        for group in range(1, self.timer_group_count + 1):
+            if group <= len(groups):
+                voltage, current, t = groups[group - 1]
+                params = (self._cal_voltage(channel, voltage), current, t)
+            else:
+                params = (0, 0, 0)
+            if shadow.get((channel, group)) != params:
+                cmds.append((group, params))
+        if not cmds:
+            return
+
+        lines = [f"TIMEr:SET CH{channel},{group},{v},{i},{t}" for group, (v, i, t) in cmds]
+        with self.lock:
+            if hasattr(self.inst, "write_many"):
+                self._io(lambda: self.inst.write_many(lines))
+            else:
+                for line in lines:
+                    self._write(line)
+            for group, params in cmds:
+                shadow[(channel, group)] = params
+            self._unchecked_cmds.extend(lines)
+            self.flush_errors()
 
     ##################################
     #### etc functions  ##############
     ##################################
+    def _read_error(self):
+        '''
+        Pop one entry off the error queue, returns (code, message) or None if there is no error
+        '''
+        response = self._query("SYSTem:ERRor?")
+        resp_list = response.split('  ')
+        # If error code zero there is no error
+        if resp_list[0] == '0':
+            return None
+        # Remove the line ending at the end of the message
+        message = resp_list[1].strip() if len(resp_list) > 1 else ''
+        return resp_list[0], message
+
     def check_error(self):
         '''
         Check for an error on the system
         '''
-        self.inst.write("SYSTem:ERRor?")
-        response = self.inst.read()
-        resp_list = response.split('  ')
+        error = self._read_error()
         # If error code zero do not raise exception, move along
-        if resp_list[0] == '0':
+        if error is None:
             return False
-        # Remove the newline at the end of the message
-        resp_list[1] = resp_list[1][:-1]
         # Raise a response with the error code and message
-        raise self.SPD3303Exception(resp_list[0], resp_list[1])
+        raise self.SPD3303Exception(error[0], error[1])
 
     def check_version(self):
         '''
         Query the software version of the equipment
         '''
-        self.inst.write("SYSTem:VERSion?")
-        return self.inst.read()
+        return self._query("SYSTem:VERSion?")
 
     def _decode_hex(self, hex_value):
         # Convert hex value to an integer
@@ -390,8 +794,7 @@ class SPD3303X(Equipment):
         '''
         Return the top level info about the power supply functional status
         '''
-        self.inst.write("SYSTem:STATus?")
-        hex_num = self.inst.read()
+        hex_num = self._query("SYSTem:STATus?")
         return self._decode_hex(hex_num)
 
     ##################################
@@ -408,8 +811,7 @@ class SPD3303X(Equipment):
         '''
         Query the static Internet Protocol (IP) address for the instrument
         '''
-        self.inst.write(f"IPaddr?")
-        return self.inst.read()
+        return self._query(f"IPaddr?")
 
     def assign_subnet_mask(self, subnet_mask):
         '''
@@ -422,8 +824,7 @@ class SPD3303X(Equipment):
         '''
         Query the subnet mask for the instrument
         '''
-        self.inst.write(f"MASKaddr?")
-        return self.inst.read()
+        return self._query(f"MASKaddr?")
 
     def assign_gate_address(self, gate_addr):
         '''
@@ -437,24 +838,22 @@ class SPD3303X(Equipment):
         Query the gate address for the instrument
         WARING: This command is invalid when DHCP is on
         '''
-        self.inst.write(f"GATEaddr?")
-        return self.inst.read()
+        return self._query(f"GATEaddr?")
 
     def dhcp(self, state):
         '''
         Turn on or off DHCP
         '''
         if state:
-            self.inst.write(f"DHCP ON")
+            self._write(f"DHCP ON")
         else:
-            self.inst.write(f"DHCP OFF")
+            self._write(f"DHCP OFF")
 
     def query_dhcp(self):
         '''
         Query to see the status of DHCP
         '''
-        self.inst.write(f"DHCP?")
-        return self.inst.read()
+        return self._query(f"DHCP?")
 
     ##################################
     #### calibration functions  ######
@@ -463,17 +862,17 @@ class SPD3303X(Equipment):
         #cmd = f"CAL:VOLT ch{channel},{point},{actual_v}"
         cmd = f"CALibration:VOLTage CH{channel},{point},{actual_v}"
         print(cmd)
-        self.inst.write(cmd)
+        self._write(cmd)
 
     def cal_current(self, channel, point, actual_i):
         cmd = f"CAL:CURR CH{channel},{point},{actual_i}"
         print(cmd)
-        self.inst.write(cmd)
+        self._write(cmd)
 
     def cal_recall(self):
         cmd = "*CALRCL"
         print(f"SPD3303X: querying {cmd}")
-        print(self.inst.query("CALRCL"))
+        print(self._query("CALRCL"))
 
     def cal_clear(self, channel, cal_type):
         NR1 = -1  # for "setting" calibration coefficients
@@ -493,12 +892,12 @@ class SPD3303X(Equipment):
                 NR1 = 6
                 NR2 = 7
 
-        self.inst.write(f"*CALCLS {NR1}")
-        self.inst.write(f"*CALCLS {NR2}")
+        self._write(f"*CALCLS {NR1}")
+        self._write(f"*CALCLS {NR2}")
         print(f"Cleared calibration with NR values of {NR1},{NR2}")
 
     def cal_clear_all(self):
-        self.inst.write("*CALCLS 8")
+        self._write("*CALCLS 8")
 
     def cal_save(self):
-        self.inst.write("*CALST")
+        self._write("*CALST")
@@ -0,0 +1,88 @@
+"""
+@file     bench_transport.py
+@author   Anders Bandt
+@brief    Round trip latency of the raw socket transport vs the pyvisa path
+
+Runs against the local stand-in server by default, or a real supply with --host:
+
+    python -m EEequipment.spd3303x.bench_transport -n 2000
+    python -m EEequipment.spd3303x.bench_transport --host 192.168.1.50
+"""
+
+# import needed modules
+import argparse
+import statistics
+import time
+from pyvisa import ResourceManager
+
+# import user created modules
+from EEequipment.SCPISocket import SCPISocket
+from EEequipment.spd3303x.scpi_stub_server import StubSPD3303XServer
+
+
+def _time_queries(query, cmd, n):
+    # one warm up query so connection setup isn't counted
+    query(cmd)
+    times = []
+    for _ in range(n):
+        t0 = time.perf_counter()
+        query(cmd)
+        times.append(time.perf_counter() - t0)
+    return times
+
+
+def _report(name, times):
+    times = sorted(times)
+    p99 = times[min(len(times) - 1, int(len(times) * 0.99))]
+    print("{:<22} median:{:8.1f}us  min:{:8.1f}us  p99:{:8.1f}us  rate:{:8.0f}/s".format(
+        name,
+        statistics.median(times) * 1e6,
+        times[0] * 1e6,
+        p99 * 1e6,
+        len(times) / sum(times)))
+
+
+def bench(host, port, n, cmd="MEASure:VOLTage? CH1"):
+    results = {}
+
+    sock = SCPISocket(host, port)
+    results["socket"] = _time_queries(sock.query, cmd, n)
+
+    # pipelined: the same number of queries sent in bursts of 4
+    burst = [cmd] * 4
+    t0 = time.perf_counter()
+    for _ in range(n // 4):
+        sock.query_many(burst)
+    per_query = (time.perf_counter() - t0) / (4 * (n // 4))
+    sock.close()
+
+    try:
+        rm = ResourceManager('@py')
+    except ValueError:
+        rm = ResourceManager()
+    inst = rm.open_resource(f"TCPIP0::{host}::{port}::SOCKET")
+    inst.write_termination = '\n'
+    inst.read_termination = '\n'
+    inst.timeout = 1000
+    results["pyvisa"] = _time_queries(inst.query, cmd, n)
+    inst.close()
+
+    for name, times in results.items():
+        _report(name, times)
+    print("{:<22} mean:{:10.1f}us per query".format("socket pipelined x4", per_query * 1e6))
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="SPD3303X transport round trip benchmark")
+    parser.add_argument("--host", default=None, help="supply address, default: local stand-in server")
+    parser.add_argument("--port", type=int, default=SCPISocket.DEFAULT_PORT)
+    parser.add_argument("-n", type=int, default=1000, help="queries per transport")
+    args = parser.parse_args()
+
+    if args.host is None:
+        with StubSPD3303XServer() as server:
+            print(f"Benchmarking against stand-in server {server.host}:{server.port}")
+            bench(server.host, server.port, args.n)
+    else:
+        bench(args.host, args.port, args.n)
@@ -0,0 +1,257 @@
+"""
+@file     calibration.py
+@author   Anders Bandt
+@brief    Automated SPD3303X output voltage calibration with the XDM1041
+
+Sweeps a channel through N raw setpoints, reads each one back with the DMM once the reading
+has settled, fits a correction (polynomial least squares or piecewise linear) from wanted
+voltage to the value that has to be commanded, and saves it as a versioned coefficient file
+that SPD3303X picks up on the next start:
+
+    psu = SPD3303X(address)
+    dmm = XDM1041("/dev/ttyUSB0", XDM1041Mode.MODE_VOLTAGE_DC)
+    corrections = calibrate(psu, dmm, channels=(1, 2), points=16)
+
+The correction is applied through a table precomputed on a fine grid, so set_voltage only
+pays for one interpolation.
+"""
+
+# import needed modules
+import collections
+import configparser
+import glob
+import os
+import re
+import time
+import numpy as np
+
+
+CAL_DIR = "./EEequipment/spd3303x/cal"
+CAL_FILE_FORMAT = "spd3303x_cal_v{:03d}.ini"
+CAL_FILE_PATTERN = re.compile(r"spd3303x_cal_v(\d+)\.ini$")
+
+SweepResult = collections.namedtuple("SweepResult", ["channel", "commanded", "measured", "settled", "elapsed"])
+
+
+class VoltageCorrection:
+    """
+    Map from wanted output voltage to the value to command, for one channel
+
+    kind "poly": commanded = polyval(coeffs, wanted), coeffs highest power first
+    kind "piecewise": linear interpolation between the measured (wanted, commanded) knots
+
+    Both are evaluated once on a grid of `step` volts over [v_min, v_max] when the object is
+    made, command() / wanted() then just interpolate in that table. Outside [v_min, v_max] the
+    table is extended linearly with the slope at its ends
+    """
+
+    def __init__(self, kind, v_min, v_max, coeffs=None, knots=None, rms=None, step=0.001):
+        self.kind = kind
+        self.v_min = float(v_min)
+        self.v_max = float(v_max)
+        self.coeffs = None if coeffs is None else np.asarray(coeffs, dtype=float)
+        self.knots = None if knots is None else (np.asarray(knots[0], dtype=float), np.asarray(knots[1], dtype=float))
+        self.rms = rms  # fit residual (V), informational
+        self.step = step
+
+        self._grid = np.arange(self.v_min, self.v_max + step / 2, step)
+        if kind == "poly":
+            self._table = np.polyval(self.coeffs, self._grid)
+        elif kind == "piecewise":
+            self._table = np.interp(self._grid, self.knots[0], self.knots[1])
+        else:
+            raise ValueError(f"Unknown correction kind: {kind}")
+        if np.any(np.diff(self._table) <= 0):
+            raise ValueError("Correction is not monotonic over the calibrated range, refusing to use it")
+
+    @staticmethod
+    def _extrapolated(x, xs, ys):
+        # np.interp holds the end values, continue the end segments instead
+        y = np.interp(x, xs, ys)
+        if len(xs) < 2:
+            return y
+        lo_slope = (ys[1] - ys[0]) / (xs[1] - xs[0])
+        hi_slope = (ys[-1] - ys[-2]) / (xs[-1] - xs[-2])
+        y = np.where(x < xs[0], ys[0] + (x - xs[0]) * lo_slope, y)
+        return np.where(x > xs[-1], ys[-1] + (x - xs[-1]) * hi_slope, y)
+
+    def command(self, voltage):
+        '''
+        Value to send for the wanted voltage
+        '''
+        return self._extrapolated(voltage, self._grid, self._table)
+
+    def wanted(self, commanded):
+        '''
+        Inverse of command(), for setpoints read back from the supply
+        '''
+        return self._extrapolated(commanded, self._table, self._grid)
+
+
+def sweep_channel(psu, dmm, channel, v_min=0.0, v_max=30.0, points=16, current=0.1,
+                  criterion=None, timeout=3.0, step_delay=0.2) -> SweepResult:
+    '''
+    Step the channel through `points` raw (uncorrected) setpoints and read each with the DMM
+    after it settles. Each step waits step_delay seconds for the output to move and throws the
+    first reading away, so a point never gets the previous setpoint's value
+    The output is turned off again afterwards. Keep current low, the DMM is the only load
+    '''
+    commanded = np.round(np.linspace(v_min, v_max, points), 3)
+    measured = np.empty(points)
+    settled = np.zeros(points, dtype=bool)
+
+    # only the sweep needs the meter, loading a saved calibration doesn't pull xdm1041 in
+    from EEequipment.xdm1041.xdm1041defs import XDM1041Mode
+    dmm.set_mode(XDM1041Mode.MODE_VOLTAGE_DC)
+    t0 = time.monotonic()
+    try:
+        with psu.batch():
+            psu.set_current(channel, current)
+            psu.set_raw_voltage(channel, commanded[0])
+        psu.output_on(channel)
+        for k, value in enumerate(commanded):
+            if k:
+                psu.set_raw_voltage(channel, value)
+            time.sleep(step_delay)
+            # the first reading after a step can still be the last conversion, skip it
+            result = dmm.wait_settled(criterion, timeout, discard=1)
+            if result.value is None:
+                # no reading at all, keep the point out of the fit
+                measured[k] = np.nan
+                settled[k] = False
+                print(f"CAL CH{channel}: set {value:.3f} V -> no reading")
+                continue
+            measured[k] = result.value
+            settled[k] = result.settled
+            print(f"CAL CH{channel}: set {value:.3f} V -> measured {result.value:.4f} V"
+                  f"{'' if result.settled else ' (not settled)'}")
+    finally:
+        psu.output_off(channel)
+        psu.set_raw_voltage(channel, 0)
+    return SweepResult(channel, commanded, measured, settled, time.monotonic() - t0)
+
+
+def fit_correction(sweep: SweepResult, kind="poly", degree=2, step=0.001) -> VoltageCorrection:
+    '''
+    Fit the commanded voltage as a function of the measured voltage
+    Unsettled points are left out of the fit
+    '''
+    wanted = sweep.measured[sweep.settled]
+    commanded = sweep.commanded[sweep.settled]
+    if len(wanted) < 2:
+        raise ValueError(f"CH{sweep.channel}: not enough settled points to fit a correction")
+    order = np.argsort(wanted)
+    wanted, commanded = wanted[order], commanded[order]
+    v_min, v_max = max(wanted[0], 0.0), wanted[-1]
+
+    if kind == "poly":
+        degree = min(degree, len(wanted) - 1)
+        vander = np.vander(wanted, degree + 1)
+        coeffs, *_ = np.linalg.lstsq(vander, commanded, rcond=None)
+        rms = float(np.sqrt(np.mean((vander @ coeffs - commanded) ** 2)))
+        return VoltageCorrection("poly", v_min, v_max, coeffs=coeffs, rms=rms, step=step)
+    elif kind == "piecewise":
+        return VoltageCorrection("piecewise", v_min, v_max, knots=(wanted, commanded), rms=0.0, step=step)
+    raise ValueError(f"Unknown correction kind: {kind}")
+
+
+##################################
+#### coefficient files  ##########
+##################################
+def _cal_files(directory):
+    files = []
+    for path in glob.glob(os.path.join(directory, "spd3303x_cal_v*.ini")):
+        match = CAL_FILE_PATTERN.search(path)
+        if match:
+            files.append((int(match.group(1)), path))
+    return sorted(files)
+
+
+def save_calibration(corrections, directory=CAL_DIR, serial=""):
+    '''
+    Write {channel: VoltageCorrection} to the next version file in directory, returns the path
+    Old versions are kept so a bad calibration can be rolled back by deleting the newest file
+    '''
+    os.makedirs(directory, exist_ok=True)
+    files = _cal_files(directory)
+    version = files[-1][0] + 1 if files else 1
+
+    config = configparser.ConfigParser()
+    config["META"] = {
+        "version": str(version),
+        "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "serial": serial,
+    }
+    for channel, corr in sorted(corrections.items()):
+        section = {
+            "kind": corr.kind,
+            "v_min": repr(corr.v_min),
+            "v_max": repr(corr.v_max),
+            "step": repr(corr.step),
+            "rms": repr(corr.rms),
+        }
+        if corr.kind == "poly":
+            section["coeffs"] = ", ".join(repr(float(c)) for c in corr.coeffs)
+        else:
+            section["knots_v"] = ", ".join(repr(float(v)) for v in corr.knots[0])
+            section["knots_cmd"] = ", ".join(repr(float(v)) for v in corr.knots[1])
+        config[f"CH{channel}"] = section
+
+    path = os.path.join(directory, CAL_FILE_FORMAT.format(version))
+    with open(path, "w") as f:
+        config.write(f)
+    print(f"Saved calibration version {version} to {path}")
+    return path
+
+
+def load_calibration(path=None, directory=CAL_DIR):
+    '''
+    Read a coefficient file (the newest version in directory by default)
+    Returns {channel: VoltageCorrection}, empty if there is no file
+    '''
+    if path is None:
+        files = _cal_files(directory)
+        if not files:
+            return {}
+        path = files[-1][1]
+
+    def floats(text):
+        return [float(x) for x in text.split(",")]
+
+    config = configparser.ConfigParser()
+    config.read(path)
+    corrections = {}
+    for name in config.sections():
+        if not name.startswith("CH"):
+            continue
+        section = config[name]
+        kwargs = {"rms": float(section.get("rms", "nan")), "step": float(section.get("step", "0.001"))}
+        if section["kind"] == "poly":
+            kwargs["coeffs"] = floats(section["coeffs"])
+        else:
+            kwargs["knots"] = (floats(section["knots_v"]), floats(section["knots_cmd"]))
+        corrections[int(name[2:])] = VoltageCorrection(section["kind"], float(section["v_min"]), float(section["v_max"]), **kwargs)
+    return corrections
+
+
+def calibrate(psu, dmm, channels=(1, 2), points=16, v_min=0.0, v_max=30.0, kind="poly", degree=2,
+              current=0.1, criterion=None, timeout=3.0, connect=None, save=True, directory=CAL_DIR):
+    '''
+    Sweep and fit every channel, apply the result to psu and (optionally) save it
+    connect(channel) is called before each channel's sweep, e.g. to switch the DMM over with
+    a relay board or to prompt for moving the leads
+    '''
+    corrections = {}
+    for channel in channels:
+        if connect is not None:
+            connect(channel)
+        sweep = sweep_channel(psu, dmm, channel, v_min, v_max, points, current, criterion, timeout)
+        corr = fit_correction(sweep, kind, degree)
+        print(f"CAL CH{channel}: {kind} fit over {corr.v_min:.3f}-{corr.v_max:.3f} V, "
+              f"rms {corr.rms * 1000:.2f} mV, sweep took {sweep.elapsed:.1f}s")
+        corrections[channel] = corr
+
+    psu.set_calibration(corrections)
+    if save:
+        save_calibration(corrections, directory, serial=psu.series_number)
+    return corrections
@@ -0,0 +1,147 @@
+"""
+@file     energy.py
+@author   Anders Bandt
+@brief    Streaming charge/energy integration over timestamped V/I samples
+"""
+
+# import needed modules
+import threading
+import time
+import numpy as np
+
+
+class PhaseStats:
+    """
+    Running totals for one test phase (or the whole capture)
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.charge = 0.0  # C
+        self.energy = 0.0  # J
+        self.duration = 0.0  # s
+        self.peak_power = 0.0  # W
+        self.intervals = 0
+
+    @property
+    def avg_power(self):
+        return self.energy / self.duration if self.duration > 0 else 0.0
+
+    @property
+    def avg_current(self):
+        return self.charge / self.duration if self.duration > 0 else 0.0
+
+    def as_dict(self):
+        return {
+            "charge": self.charge,
+            "energy": self.energy,
+            "duration": self.duration,
+            "avg_power": self.avg_power,
+            "avg_current": self.avg_current,
+            "peak_power": self.peak_power,
+        }
+
+    def __repr__(self):
+        return (f"PhaseStats({self.name!r}, charge={self.charge:.6g} C, energy={self.energy:.6g} J, "
+                f"duration={self.duration:.6g} s, peak_power={self.peak_power:.6g} W)")
+
+
+class EnergyIntegrator:
+    """
+    Integrates chunks of (t, V, I) samples with the trapezoidal rule and keeps only running
+    totals, so memory stays constant no matter how long the capture runs. The last sample of
+    each chunk is kept to bridge into the next one.
+
+    mark(name) starts a new test phase at time t (time.monotonic() by default, the same clock
+    the SPD3303X logger and snapshots use). Each interval between two samples is booked to the
+    phase active at its start.
+    """
+
+    START_PHASE = "start"
+
+    def __init__(self):
+        self.total = PhaseStats("total")
+        self.phases = {self.START_PHASE: PhaseStats(self.START_PHASE)}
+        self._marker_t = []
+        self._marker_names = []
+        self._last = None  # (t, v, i) of the last sample seen
+        self._lock = threading.Lock()
+
+    def mark(self, name, t=None):
+        '''
+        Start phase `name` at time t, markers must be added in time order
+        '''
+        if t is None:
+            t = time.monotonic()
+        with self._lock:
+            if self._marker_t and t < self._marker_t[-1]:
+                raise ValueError("Phase markers must be added in time order")
+            self._marker_t.append(t)
+            self._marker_names.append(name)
+            if name not in self.phases:
+                self.phases[name] = PhaseStats(name)
+
+    def update(self, t, v, i):
+        '''
+        Add a chunk of samples, t in seconds (increasing), v in volts, i in amps
+        '''
+        t = np.atleast_1d(np.asarray(t, dtype=np.float64))
+        v = np.atleast_1d(np.asarray(v, dtype=np.float64))
+        i = np.atleast_1d(np.asarray(i, dtype=np.float64))
+        if len(t) == 0:
+            return
+        with self._lock:
+            if self._last is not None:
+                t = np.concatenate(([self._last[0]], t))
+                v = np.concatenate(([self._last[1]], v))
+                i = np.concatenate(([self._last[2]], i))
+            self._last = (t[-1], v[-1], i[-1])
+
+            p = v * i
+            if len(p):
+                self.total.peak_power = max(self.total.peak_power, float(np.max(p)))
+            if len(t) < 2:
+                return
+
+            dt = np.diff(t)
+            dq = 0.5 * (i[1:] + i[:-1]) * dt
+            de = 0.5 * (p[1:] + p[:-1]) * dt
+            p_int = np.maximum(p[1:], p[:-1])
+
+            self._book(self.total, dq, de, dt, p_int)
+
+            # split the intervals over the phases by the marker active at their start
+            names = [self.START_PHASE] + self._marker_names
+            idx = np.searchsorted(np.asarray(self._marker_t), t[:-1], side="right")
+            for k in np.unique(idx):
+                sel = idx == k
+                self._book(self.phases[names[k]], dq[sel], de[sel], dt[sel], p_int[sel])
+
+    @staticmethod
+    def _book(stats, dq, de, dt, p_int):
+        stats.charge += float(np.sum(dq))
+        stats.energy += float(np.sum(de))
+        stats.duration += float(np.sum(dt))
+        stats.intervals += len(dt)
+        if len(p_int):
+            stats.peak_power = max(stats.peak_power, float(np.max(p_int)))
+
+    def update_records(self, records, channel):
+        '''
+        Add a structured array from SPD3303XLogger / SPD3303X.snapshots() for one channel
+        '''
+        self.update(records["t"], records[f"ch{channel}_v"], records[f"ch{channel}_i"])
+
+    def consumer(self, channel):
+        '''
+        Callable to hand to SPD3303XLogger(consumers=[...]) so every flushed chunk is integrated
+        '''
+        return lambda records: self.update_records(records, channel)
+
+    def summary(self):
+        with self._lock:
+            res = {"total": self.total.as_dict()}
+            for name, stats in self.phases.items():
+                if stats.intervals:
+                    res[name] = stats.as_dict()
+            return res
@@ -0,0 +1,255 @@
+"""
+@file     interlock.py
+@author   Anders Bandt
+@brief    Over-current safety interlock for the SPD3303X
+
+A dedicated thread polls MEASure:CURRent? on the watched channels as fast as the bus allows and
+turns the output off when a rule trips:
+
+    interlock = SPD3303XInterlock(psu)
+    interlock.watch(1, max_current=0.5, max_didt=20.0)   # 0.5 A, or rising faster than 20 A/s
+    interlock.start()
+    ... long test ...
+    print(interlock.latency_stats())
+    interlock.stop()
+
+The OFF command goes through the urgent side of the session lock (SPD3303X.emergency_off), so
+it only waits for the exchange already on the bus, not for other threads' queued commands.
+A tripped channel stays latched (not polled, output left off) until rearm(). If the OFF write
+fails it is retried, then sent as a plain output_off; channels that still couldn't be turned off
+are kept in off_pending and retried on every loop, `faulted` is True while any are left.
+"""
+
+# import needed modules
+import collections
+import threading
+import time
+import numpy as np
+
+
+TripEvent = collections.namedtuple(
+    "TripEvent",
+    ["t", "channel", "rule", "current", "didt", "latency", "poll_period"])
+
+# per channel rules, None disables a rule, max_didt is in A/s (rising current only)
+ChannelRule = collections.namedtuple("ChannelRule", ["max_current", "max_didt", "count"])
+
+
+class SPD3303XInterlock:
+    """
+    latency of a trip is from the reply of the poll that tripped to the OFF write leaving the
+    host, poll_period (the time between polls) bounds how late a fault is seen in the first place
+    (latency stays None when the output couldn't be turned off right away)
+    """
+
+    def __init__(self, psu, poll_interval=0.0, trip_all=False, on_trip=None):
+        self.psu = psu
+        self.poll_interval = poll_interval  # s between polls, 0 polls back to back
+        self.trip_all = trip_all  # turn every output off on a trip, not just the faulty channel
+        self.on_trip = on_trip  # called with the TripEvent from the interlock thread
+        self.rules = {}
+        self.tripped = {}
+        self.events = []
+        self.polls = 0
+        self.errors = 0
+        self.last_error = None
+        self.off_retries = 3  # emergency_off attempts before falling back to output_off
+        self.off_pending = set()  # tripped channels whose output couldn't be turned off yet
+        self._periods = collections.deque(maxlen=10000)
+        self._over = {}
+        self._last = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def watch(self, channel, max_current=None, max_didt=None, count=1):
+        '''
+        Add or change the rule for a channel, count is how many consecutive polls over
+        max_current it takes to trip (1 is the fastest, more rides through single glitches)
+        '''
+        if max_current is None and max_didt is None:
+            raise ValueError("Need a max_current or max_didt rule")
+        with self._lock:
+            self.rules[channel] = ChannelRule(max_current, max_didt, count)
+            self._over[channel] = 0
+            self._last.pop(channel, None)
+
+    def unwatch(self, channel):
+        with self._lock:
+            self.rules.pop(channel, None)
+            self.tripped.pop(channel, None)
+
+    def rearm(self, channel):
+        '''
+        Clear a latched trip, the output has to be turned back on by the caller
+        '''
+        with self._lock:
+            self.tripped.pop(channel, None)
+            self._over[channel] = 0
+            self._last.pop(channel, None)
+
+    def start(self):
+        if self._thread is not None:
+            return self
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="SPD3303XInterlock", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    @property
+    def faulted(self):
+        # a trip happened but the output could not be turned off (yet)
+        return bool(self.off_pending)
+
+    def _error(self, msg, e):
+        self.errors += 1
+        self.last_error = e
+        print(f"SPD3303X INTERLOCK: {msg}: {e}")
+
+    def _poll(self, channels):
+        psu = self.psu
+        resp = psu.query_many([f"MEASure:CURRent? CH{ch}" for ch in channels])
+        t = time.monotonic()
+        offsets = {1: psu.ch1_i_b, 2: psu.ch2_i_b}
+        return t, [float(r) - offsets.get(ch, 0.0) for ch, r in zip(channels, resp)]
+
+    def _check(self, channel, rule, t, current):
+        # returns (rule name, dI/dt) when the channel trips
+        didt = None
+        last = self._last.get(channel)
+        self._last[channel] = (t, current)
+        if last is not None and t > last[0]:
+            didt = (current - last[1]) / (t - last[0])
+
+        if rule.max_current is not None and current > rule.max_current:
+            self._over[channel] += 1
+            if self._over[channel] >= rule.count:
+                return "current", didt
+        else:
+            self._over[channel] = 0
+        if rule.max_didt is not None and didt is not None and didt > rule.max_didt:
+            return "didt", didt
+        return None, didt
+
+    def _output_off(self, channels):
+        # emergency_off with retries, then a plain output_off per channel
+        # returns the time the OFF went out, None if the output could not be turned off
+        names = ", ".join(f"CH{ch}" for ch in channels)
+        for attempt in range(self.off_retries):
+            try:
+                return self.psu.emergency_off(channels)
+            except Exception as e:
+                self._error(f"emergency off of {names} failed (attempt {attempt + 1})", e)
+        try:
+            for ch in channels:
+                self.psu.output_off(ch, force=True)
+            return time.monotonic()
+        except Exception as e:
+            self._error(f"output off of {names} failed, output may still be ON", e)
+            return None
+
+    def _trip(self, channel, rule_name, t, current, didt, period):
+        channels = list(range(1, self.psu.channel_count + 1)) if self.trip_all else [channel]
+        # latch the trip before anything that can fail, latency is filled in once the output is off
+        event = TripEvent(t, channel, rule_name, current, didt, None, period)
+        with self._lock:
+            for ch in channels:
+                if ch in self.rules:
+                    self.tripped[ch] = event
+            self.events.append(event)
+            index = len(self.events) - 1
+
+        t_off = self._output_off(channels)
+        if t_off is None:
+            self.off_pending.update(channels)
+        else:
+            done = event._replace(latency=t_off - t)
+            with self._lock:
+                for ch, tripped in self.tripped.items():
+                    if tripped is event:
+                        self.tripped[ch] = done
+                self.events[index] = done
+            event = done
+        print(f"SPD3303X INTERLOCK: CH{channel} tripped on {rule_name} ({current:.3f} A"
+              f"{'' if didt is None else f', {didt:.1f} A/s'}), "
+              + ("OUTPUT NOT OFF, retrying" if t_off is None else f"output off after {event.latency * 1000:.2f} ms"))
+        if self.on_trip is not None:
+            try:
+                self.on_trip(event)
+            except Exception as e:
+                self._error("on_trip callback failed", e)
+
+    def _retry_off(self):
+        channels = sorted(self.off_pending)
+        if self._output_off(channels) is not None:
+            self.off_pending.difference_update(channels)
+            print(f"SPD3303X INTERLOCK: {', '.join(f'CH{ch}' for ch in channels)} finally turned off")
+
+    def _run(self):
+        t_prev = None
+        while not self._stop.is_set():
+            if self.off_pending:
+                self._retry_off()
+                if self.off_pending:
+                    self._stop.wait(0.01)
+                    continue
+            with self._lock:
+                channels = [ch for ch in self.rules if ch not in self.tripped]
+            if not channels:
+                self._stop.wait(0.01)
+                t_prev = None
+                continue
+            try:
+                t, currents = self._poll(channels)
+            except Exception as e:
+                self._error("poll failed", e)
+                self._stop.wait(0.01)
+                continue
+            period = None if t_prev is None else t - t_prev
+            if period is not None:
+                self._periods.append(period)
+            t_prev = t
+            self.polls += 1
+
+            for ch, current in zip(channels, currents):
+                with self._lock:
+                    rule = self.rules.get(ch)
+                    if rule is None:
+                        continue
+                    rule_name, didt = self._check(ch, rule, t, current)
+                if rule_name is not None:
+                    self._trip(ch, rule_name, t, current, didt, period)
+            if self.poll_interval:
+                self._stop.wait(self.poll_interval)
+
+    def latency_stats(self):
+        '''
+        Trip latency (poll reply -> OFF written) and poll period statistics in seconds
+        '''
+        def stats(values):
+            if not len(values):
+                return None
+            arr = np.asarray(values, dtype=float)
+            return {"n": len(arr), "min": arr.min(), "mean": arr.mean(),
+                    "p99": np.percentile(arr, 99), "max": arr.max()}
+
+        with self._lock:
+            latencies = [event.latency for event in self.events if event.latency is not None]
+            periods = list(self._periods)
+        return {"trip_latency": stats(latencies), "poll_period": stats(periods), "trips": len(latencies)}
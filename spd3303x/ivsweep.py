@@ -0,0 +1,174 @@
+"""
+@file     ivsweep.py
+@author   Anders Bandt
+@brief    IV curve sweeps: SPD3303X sources the voltage, SPD3303X and/or XDM1041 measure
+
+Starts from a coarse uniform sweep and then only adds points where the curve bends
+(diode knees, regulator dropout, current limit), instead of a fine sweep over the whole range:
+
+    sweep = IVSweep(psu, 1, dmm, dmm_quantity="current")
+    curve = sweep.run(0.0, 5.0, coarse_points=11, min_step=0.01)
+    plt.plot(curve.v, curve.i)
+
+Per point the DMM query and the supply readback for point k are sent, then the supply is moved
+to point k+1 and only then is the DMM reply read, so the supply settles while the (slow, serial)
+DMM answers.
+"""
+
+# import needed modules
+import collections
+import time
+import numpy as np
+
+# import user created modules
+from EEequipment.xdm1041.xdm1041defs import XDM1041Cmd
+
+
+# all arrays sorted by set_v, dmm is nan without a DMM, v / i are the quantities used for the curve
+IVCurve = collections.namedtuple("IVCurve", ["set_v", "v", "i", "psu_v", "psu_i", "dmm", "t", "passes"])
+
+
+class IVSweep:
+    """
+    dmm_quantity says what the DMM is wired to measure: "current" (in series with the load),
+    "voltage" (across the load) or None to use the supply readback only
+    The DMM has to already be in the matching mode and range
+    """
+
+    def __init__(self, psu, channel, dmm=None, dmm_quantity=None, settle_time=0.05, current_limit=None):
+        if dmm is not None and dmm_quantity not in ("current", "voltage"):
+            raise ValueError('dmm_quantity must be "current" or "voltage" when a DMM is given')
+        self.psu = psu
+        self.channel = channel
+        self.dmm = dmm
+        self.dmm_quantity = dmm_quantity if dmm is not None else None
+        self.settle_time = settle_time  # s from a setpoint change to the reading
+        self.current_limit = current_limit
+
+        self.reset()
+
+    def reset(self):
+        self.set_v = []
+        self.psu_v = []
+        self.psu_i = []
+        self.dmm_val = []
+        self.t = []
+
+    def _record(self, set_v, psu_v, psu_i, finish):
+        dmm_val = np.nan
+        if finish is not None:
+            resp = finish()
+            dmm_val = float(resp) if resp else np.nan
+        self.set_v.append(set_v)
+        self.psu_v.append(psu_v)
+        self.psu_i.append(psu_i)
+        self.dmm_val.append(dmm_val)
+        self.t.append(time.monotonic())
+
+    def _measure(self, setpoints):
+        '''
+        One pass over the setpoints (ascending), with the DMM read of each point overlapped
+        with the supply moving to the next one
+        '''
+        psu = self.psu
+        ch = self.channel
+        previous = None
+        t_set = time.monotonic()
+        with psu.batch():
+            for v in list(setpoints) + [None]:
+                finish = None
+                try:
+                    if previous is not None:
+                        # point `previous` has settled, trigger both readings before moving on
+                        delay = t_set + self.settle_time - time.monotonic()
+                        if delay > 0:
+                            time.sleep(delay)
+                        if self.dmm is not None:
+                            finish = self.dmm.query_async(XDM1041Cmd.MEASURE_1_RAW)
+                        psu_v, psu_i = psu.get_voltage_current(ch)
+                    if v is not None:
+                        psu.set_voltage(ch, v)
+                        t_set = time.monotonic()
+                except BaseException:
+                    if finish is not None:
+                        finish()  # read the reply anyway so the meter is unlocked
+                    raise
+                if previous is not None:
+                    self._record(previous, psu_v, psu_i, finish)
+                previous = v
+
+    def curve(self, passes=0) -> IVCurve:
+        order = np.argsort(self.set_v, kind="stable")
+        set_v = np.asarray(self.set_v)[order]
+        psu_v = np.asarray(self.psu_v)[order]
+        psu_i = np.asarray(self.psu_i)[order]
+        dmm = np.asarray(self.dmm_val, dtype=float)[order]
+        t = np.asarray(self.t)[order]
+        v = dmm if self.dmm_quantity == "voltage" else psu_v
+        i = dmm if self.dmm_quantity == "current" else psu_i
+        return IVCurve(set_v, v, i, psu_v, psu_i, dmm, t, passes)
+
+    @staticmethod
+    def bends(x, y, tolerance):
+        '''
+        Indices of interior points that are further than tolerance (fraction of the y span)
+        from the straight line through their neighbours
+        '''
+        if len(x) < 3:
+            return np.array([], dtype=int)
+        span = np.nanmax(y) - np.nanmin(y)
+        if not span > 0:
+            return np.array([], dtype=int)
+        x0, x1, x2 = x[:-2], x[1:-1], x[2:]
+        y0, y1, y2 = y[:-2], y[1:-1], y[2:]
+        line = y0 + (y2 - y0) * (x1 - x0) / (x2 - x0)
+        dev = np.abs(y1 - line) / span
+        return np.nonzero(dev > tolerance)[0] + 1
+
+    def refine_points(self, curve, tolerance, min_step):
+        '''
+        New setpoints: the midpoints of the intervals either side of every bend, as long as
+        the interval is still wider than min_step
+        '''
+        x, y = curve.set_v, curve.i
+        known = set(x)
+        new = set()
+        for k in self.bends(x, y, tolerance):
+            for a, b in ((x[k - 1], x[k]), (x[k], x[k + 1])):
+                if b - a > min_step:
+                    new.add(round((a + b) / 2, 3))
+        return sorted(new - known)
+
+    def run(self, v_start, v_stop, coarse_points=11, tolerance=0.02, min_step=0.01, max_points=200,
+            output=True) -> IVCurve:
+        '''
+        Coarse sweep, then refinement passes until nothing bends more than tolerance or
+        max_points is reached. The output is turned on for the sweep and back off after it
+        '''
+        psu = self.psu
+        ch = self.channel
+        coarse = np.round(np.linspace(v_start, v_stop, coarse_points), 3)
+        self.reset()
+
+        if self.current_limit is not None:
+            psu.set_current(ch, self.current_limit)
+        psu.set_voltage(ch, coarse[0])
+        if output:
+            psu.output_on(ch)
+        passes = 1
+        try:
+            self._measure(coarse)
+            while len(self.set_v) < max_points:
+                new = self.refine_points(self.curve(), tolerance, min_step)
+                if not new:
+                    break
+                new = new[:max_points - len(self.set_v)]
+                print(f"IV sweep: pass {passes + 1}, refining with {len(new)} points")
+                self._measure(new)
+                passes += 1
+        finally:
+            if output:
+                psu.output_off(ch)
+        curve = self.curve(passes)
+        print(f"IV sweep: {len(curve.set_v)} points in {passes} passes, {curve.t.max() - curve.t.min():.1f}s")
+        return curve
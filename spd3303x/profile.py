@@ -0,0 +1,124 @@
+"""
+@file     profile.py
+@author   Anders Bandt
+@brief    Voltage profiles run on the SPD3303X timer, or host timed when they don't fit
+"""
+
+# import needed modules
+import collections
+import time
+
+
+ProfileRun = collections.namedtuple("ProfileRun", ["mode", "start", "duration", "lateness"])
+
+
+class VoltageProfile:
+    """
+    A list of (voltage, duration, current) steps. Ramps are stored as stairs.
+
+    run() compiles the profile into the supply's timer groups (TIMEr:SET) and uploads it in one
+    burst when it fits (at most timer_group_count steps, durations on the timer resolution),
+    otherwise it falls back to a host scheduler that sets every step against absolute deadlines
+    from the start time, so sleep jitter doesn't accumulate over the profile.
+
+        profile = VoltageProfile(current=0.5).hold(3.3, 2).ramp(3.3, 5.0, 3, steps=3).hold(0, 1)
+        profile.run(psu, 1)
+    """
+
+    def __init__(self, current=None):
+        self.current = current  # default current limit for steps that don't give one
+        self.steps = []
+
+    def hold(self, voltage, duration, current=None):
+        self.steps.append((float(voltage), float(duration), current))
+        return self
+
+    def ramp(self, v_start, v_stop, duration, steps=10, current=None):
+        '''
+        Linear ramp from v_start to v_stop over duration as `steps` equal stairs
+        (the last stair is v_stop)
+        '''
+        dt = duration / steps
+        for k in range(1, steps + 1):
+            self.hold(v_start + (v_stop - v_start) * k / steps, dt, current)
+        return self
+
+    @property
+    def duration(self):
+        return sum(step[1] for step in self.steps)
+
+    def _resolved_steps(self, psu, channel):
+        # fill in current limits and merge neighbours that end up identical
+        default = self.current if self.current is not None else psu.get_set_current(channel)
+        merged = []
+        for voltage, duration, current in self.steps:
+            current = default if current is None else current
+            if merged and merged[-1][0] == voltage and merged[-1][2] == current:
+                merged[-1] = (voltage, merged[-1][1] + duration, current)
+            else:
+                merged.append((voltage, duration, current))
+        return merged
+
+    def compile(self, psu, channel):
+        '''
+        Return the timer groups [(voltage, current, time), ...] for this profile,
+        or None if it doesn't fit the supply's timer
+        '''
+        steps = self._resolved_steps(psu, channel)
+        if not steps or len(steps) > psu.timer_group_count:
+            return None
+        res = psu.timer_resolution
+        groups = []
+        for voltage, duration, current in steps:
+            ticks = round(duration / res)
+            if ticks < 1 or abs(ticks * res - duration) > 1e-6:
+                return None
+            t = ticks * res
+            groups.append((voltage, current, int(t) if float(t).is_integer() else t))
+        return groups
+
+    def run(self, psu, channel, use_timer=True, wait=True, output=True) -> ProfileRun:
+        '''
+        Run the profile on a channel. With wait the call returns once the profile is done
+        (for the timer path the timer is turned off again), output turns the channel on
+        '''
+        groups = self.compile(psu, channel) if use_timer else None
+        if groups is not None:
+            return self._run_timer(psu, channel, groups, wait, output)
+        return self._run_host(psu, channel, output)
+
+    def _run_timer(self, psu, channel, groups, wait, output):
+        psu.upload_timer_groups(channel, groups)
+        start = time.monotonic()
+        psu.turn_on_timer(channel, force=True)
+        # the timer moves the setpoints behind our back, also while nobody waits for it
+        psu.invalidate_setpoints(channel)
+        if output:
+            psu.output_on(channel)
+        duration = sum(group[2] for group in groups)
+        if wait:
+            time.sleep(max(start + duration - time.monotonic(), 0))
+            psu.turn_off_timer(channel, force=True)
+            psu.invalidate_setpoints(channel)
+        return ProfileRun("timer", start, duration, [])
+
+    def _run_host(self, psu, channel, output):
+        steps = self._resolved_steps(psu, channel)
+        lateness = []
+        start = time.monotonic()
+        deadline = start
+        for k, (voltage, duration, current) in enumerate(steps):
+            delay = deadline - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            lateness.append(time.monotonic() - deadline)
+            with psu.batch():
+                psu.set_current(channel, current)
+                psu.set_voltage(channel, voltage)
+            if k == 0 and output:
+                psu.output_on(channel)
+            deadline += duration
+        delay = deadline - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        return ProfileRun("host", start, time.monotonic() - start, lateness)
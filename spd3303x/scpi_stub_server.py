@@ -0,0 +1,218 @@
+"""
+@file     scpi_stub_server.py
+@author   Anders Bandt
+@brief    Local stand-in for the SPD3303X LAN (port 5025 style) SCPI interface
+
+Answers the subset of commands SPD3303X.py uses, so the socket transport and the
+pyvisa TCPIP::SOCKET path can be exercised without the supply on the bench:
+
+    python -m EEequipment.spd3303x.scpi_stub_server --port 5025
+
+or from code:
+
+    server = StubSPD3303XServer().start()
+    psu = SPD3303X(server.address)
+    ...
+    server.stop()
+"""
+
+# import needed modules
+import argparse
+import socket
+import socketserver
+import threading
+import time
+
+
+class StubSPD3303XState:
+    """
+    Instrument state shared by every connection to one stub server
+    """
+
+    def __init__(self, load_ohms=10.0):
+        self.load_ohms = load_ohms
+        self.voltage = {1: 0.0, 2: 0.0}
+        self.current = {1: 3.2, 2: 3.2}
+        self.output = {1: False, 2: False}
+        self.timer = {1: False, 2: False}
+        self.timer_groups = {}
+        self.track = 0
+        self.active = 1
+        self.errors = []
+        self.lock = threading.Lock()
+
+    def meas_current(self, ch):
+        if not self.output[ch]:
+            return 0.0
+        return min(self.voltage[ch] / self.load_ohms, self.current[ch])
+
+    def status(self):
+        value = 0
+        for ch in (1, 2):
+            if self.output[ch]:
+                value |= 0x10 << (ch - 1)
+            if self.timer[ch]:
+                value |= 0x40 << (ch - 1)
+        value |= {0: 0x01, 1: 0x00, 2: 0x02}.get(self.track, 0) << 2
+        return hex(value)
+
+    def handle(self, line):
+        """
+        Execute one command, returns the response string or None
+        """
+        cmd = line.strip()
+        upper = cmd.upper()
+        with self.lock:
+            if upper == "*IDN?":
+                return "Siglent Technologies,SPD3303X,STUB0000000001,1.01.01.02.05,V3.0"
+            if upper.startswith("SYST:ERR") or upper.startswith("SYSTEM:ERROR"):
+                return self.errors.pop(0) if self.errors else "0  No Error"
+            if upper.startswith("SYST:STAT") or upper.startswith("SYSTEM:STATUS"):
+                return self.status()
+            if upper.startswith("SYST:VERS") or upper.startswith("SYSTEM:VERSION"):
+                return "1.01.01.02.05"
+            if upper.startswith("MEAS"):
+                head, _, arg = upper.partition(" ")
+                ch = int(arg.strip()[-1]) if arg.strip() else self.active
+                if "VOLT" in head:
+                    return f"{self.voltage[ch] if self.output[ch] else 0.0:.3f}"
+                if "CURR" in head:
+                    return f"{self.meas_current(ch):.3f}"
+                if "POWE" in head:
+                    v = self.voltage[ch] if self.output[ch] else 0.0
+                    return f"{v * self.meas_current(ch):.3f}"
+            if upper.startswith("CH1:") or upper.startswith("CH2:"):
+                ch = int(upper[2])
+                head, _, arg = upper[4:].partition(" ")
+                if head.startswith("VOLT"):
+                    if head.endswith("?"):
+                        return f"{self.voltage[ch]:.3f}"
+                    self.voltage[ch] = float(arg)
+                    return None
+                if head.startswith("CURR"):
+                    if head.endswith("?"):
+                        return f"{self.current[ch]:.3f}"
+                    self.current[ch] = float(arg)
+                    return None
+            if upper.startswith("OUTP") and ":TRACK" in upper:
+                self.track = int(upper.split()[-1])
+                return None
+            if upper.startswith("OUTP") and ":WAVE" in upper:
+                return None
+            if upper.startswith("OUTP"):
+                arg = upper.partition(" ")[2]
+                ch_str, _, state = arg.partition(",")
+                self.output[int(ch_str.strip()[-1])] = state.strip() == "ON"
+                return None
+            if upper.startswith("TIME:SET?") or upper.startswith("TIMER:SET?"):
+                ch_str, group = upper.partition(" ")[2].split(",")
+                v, i, t = self.timer_groups.get((int(ch_str[-1]), int(group)), (0.0, 0.0, 0.0))
+                return f"{v},{i},{t}"
+            if upper.startswith("TIME:SET") or upper.startswith("TIMER:SET"):
+                ch_str, group, v, i, t = upper.partition(" ")[2].split(",")
+                self.timer_groups[(int(ch_str[-1]), int(group))] = (float(v), float(i), float(t))
+                return None
+            if upper.startswith("TIME") or upper.startswith("TIMER"):
+                ch_str, _, state = upper.partition(" ")[2].partition(",")
+                self.timer[int(ch_str.strip()[-1])] = state.strip() == "ON"
+                return None
+            if upper.startswith("INST"):
+                if upper.endswith("?"):
+                    return f"CH{self.active}"
+                self.active = int(upper[-1])
+                return None
+            if upper.startswith("*SAV") or upper.startswith("*RCL"):
+                return None
+            self.errors.append("-113  Undefined header")
+            return None
+
+
+class _StubHandler(socketserver.StreamRequestHandler):
+
+    def setup(self):
+        super().setup()
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def handle(self):
+        state = self.server.state
+        delay = self.server.response_delay
+        for raw in self.rfile:
+            line = raw.decode(errors="replace").strip()
+            if not line:
+                continue
+            resp = state.handle(line)
+            if resp is not None:
+                if delay:
+                    time.sleep(delay)
+                self.wfile.write((resp + "\n").encode())
+                self.wfile.flush()
+
+
+class _StubTCPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class StubSPD3303XServer:
+    """
+    Threaded TCP server speaking the SPD3303X SCPI subset on localhost
+    response_delay (s) can be set to mimic instrument processing time
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, response_delay=0.0):
+        self.state = StubSPD3303XState()
+        self._server = _StubTCPServer((host, port), _StubHandler)
+        self._server.state = self.state
+        self._server.response_delay = response_delay
+        self._thread = None
+
+    @property
+    def host(self):
+        return self._server.server_address[0]
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    @property
+    def address(self):
+        # address string for SPD3303X / SCPISocket
+        return f"socket://{self.host}:{self.port}"
+
+    @property
+    def visa_address(self):
+        # the same server through pyvisa's raw socket resource
+        return f"TCPIP0::{self.host}::{self.port}::SOCKET"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name="StubSPD3303XServer", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stand-in SPD3303X SCPI server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5025)
+    parser.add_argument("--delay", type=float, default=0.0, help="response delay in seconds")
+    args = parser.parse_args()
+
+    server = StubSPD3303XServer(args.host, args.port, args.delay)
+    print(f"Stub SPD3303X listening on {server.address}")
+    try:
+        server._server.serve_forever()
+    except (KeyboardInterrupt, SystemExit):
+        print("Exiting")
@@ -0,0 +1,176 @@
+"""
+@file     telemetry.py
+@author   Anders Bandt
+@brief    Background voltage/current logger for the SPD3303X with columnar .npy storage
+"""
+
+# import needed modules
+import glob
+import os
+import threading
+import time
+import numpy as np
+
+
+def log_dtype(channels):
+    '''
+    Column layout of a log: monotonic timestamp then voltage/current per channel
+    '''
+    fields = [("t", np.float64)]
+    for ch in channels:
+        fields.append((f"ch{ch}_v", np.float64))
+        fields.append((f"ch{ch}_i", np.float64))
+    return np.dtype(fields)
+
+
+def load_log(path):
+    '''
+    Concatenate every chunk written by SPD3303XLogger in path into one structured array
+    '''
+    files = sorted(glob.glob(os.path.join(path, "chunk_*.npy")))
+    if not files:
+        return None
+    return np.concatenate([np.load(f) for f in files])
+
+
+def next_chunk_index(path):
+    '''
+    Index after the highest chunk_NNNNNN.npy in path (0 for none), gaps in the numbering are kept
+    '''
+    indices = []
+    for f in glob.glob(os.path.join(path, "chunk_*.npy")):
+        num = os.path.basename(f)[len("chunk_"):-len(".npy")]
+        if num.isdigit():
+            indices.append(int(num))
+    return max(indices) + 1 if indices else 0
+
+
+class SPD3303XLogger:
+    """
+    Sampler thread that logs MEASure:VOLTage?/CURRent? of the selected channels as fast as the
+    link allows (or every `interval` seconds). Samples go into fixed size chunks that are written
+    as append-only chunk_NNNNNN.npy files in `path`; read them back with load_log().
+
+    The bus is shared with the caller through the supply's lock, so the test thread can keep
+    using the supply while logging. latest() returns the last sample without touching the bus.
+    Currents have the config.ini offsets applied like get_current(). Each consumer is called
+    with every chunk as it is written (e.g. energy.EnergyIntegrator.consumer(ch)).
+    """
+
+    def __init__(self, psu, path, channels=(1, 2), chunk_size=4096, interval=0.0, consumers=None):
+        for ch in channels:
+            if ch not in range(1, psu.channel_count + 1):
+                raise psu.SPD3303Exception('21', f'Channel # must be an integer 1 - {psu.channel_count}')
+        self.psu = psu
+        self.path = path
+        self.channels = tuple(channels)
+        self.chunk_size = chunk_size
+        self.interval = interval
+        self.dtype = log_dtype(self.channels)
+        self.consumers = list(consumers) if consumers else []
+
+        self._cmds = []
+        self._offsets = []
+        for ch in self.channels:
+            self._cmds.append(f"MEASure:VOLTage? CH{ch}")
+            self._cmds.append(f"MEASure:CURRent? CH{ch}")
+            self._offsets.append(0.0)
+            self._offsets.append(psu.ch1_i_b if ch == 1 else psu.ch2_i_b)
+
+        self._chunk = np.empty(chunk_size, dtype=self.dtype)
+        self._fill = 0
+        self._chunk_index = 0
+        self._latest = None
+        self._stop = threading.Event()
+        self._thread = None
+        self.sample_count = 0
+        self.errors = 0
+        self.consumer_errors = 0
+        self.last_error = None
+
+    def start(self):
+        if self._thread is not None:
+            return self
+        os.makedirs(self.path, exist_ok=True)
+        # continue numbering after chunks already in the directory, never overwrite
+        self._chunk_index = next_chunk_index(self.path)
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="SPD3303XLogger", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        '''
+        Stop sampling and flush the partial chunk to disk
+        '''
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._flush()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def latest(self):
+        '''
+        Last logged sample as a structured record (fields t, ch1_v, ch1_i, ...) or None
+        '''
+        return self._latest
+
+    def _flush(self):
+        if self._fill == 0:
+            return
+        file_name = os.path.join(self.path, f"chunk_{self._chunk_index:06d}.npy")
+        data = self._chunk[:self._fill]
+        np.save(file_name, data)
+        for consumer in self.consumers:
+            try:
+                consumer(data)
+            except Exception as e:
+                # a broken consumer must not stop the logging, report it and carry on
+                self.consumer_errors += 1
+                self.last_error = e
+                print(f"SPD3303XLogger: consumer {consumer!r} failed: {e}")
+        self._chunk_index += 1
+        self._chunk = np.empty(self.chunk_size, dtype=self.dtype)
+        self._fill = 0
+
+    def _run(self):
+        psu = self.psu
+        cmds = self._cmds
+        offsets = self._offsets
+        next_t = time.monotonic()
+        while not self._stop.is_set():
+            try:
+                resp = psu.query_many(cmds)
+                t = time.monotonic()
+                row = (t,) + tuple(float(r) - b for r, b in zip(resp, offsets))
+            except Exception as e:
+                # keep logging through a bad read, the caller can inspect errors/last_error
+                self.errors += 1
+                self.last_error = e
+                time.sleep(0.01)
+                continue
+
+            self._chunk[self._fill] = row
+            self._latest = self._chunk[self._fill].copy()
+            self._fill += 1
+            self.sample_count += 1
+            if self._fill == self.chunk_size:
+                self._flush()
+
+            if self.interval > 0:
+                next_t += self.interval
+                delay = next_t - time.monotonic()
+                if delay > 0:
+                    self._stop.wait(delay)
+                else:
+                    next_t = time.monotonic()
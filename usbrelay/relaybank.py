@@ -0,0 +1,167 @@
+# import needed modules
+import concurrent.futures
+import threading
+import usb.core
+import usb.util
+
+# import user created modules
+from EEequipment.usbrelay.usbrelay_controller import USBRelayController, VENDOR_ID, PRODUCT_ID, _get_backend
+
+
+# (bus, port path) -> (manufacturer, product), string descriptors only change when a different
+# board is plugged into the port, so they are fetched once per port and not on every lookup
+_descriptor_cache = {}
+
+
+def _port_key(device):
+    ports = getattr(device, "port_numbers", None)
+    return device.bus, tuple(ports) if ports else ("addr", device.address)
+
+
+def _descriptors(device, refresh=False):
+    key = _port_key(device)
+    if refresh or key not in _descriptor_cache:
+        _descriptor_cache[key] = (
+            usb.util.get_string(device, device.iManufacturer),
+            usb.util.get_string(device, device.iProduct),
+        )
+    return _descriptor_cache[key]
+
+
+def find_all(refresh=False):
+    '''
+    Every dcttech USB relay board on the bus (one usb.core.find pass)
+    refresh re-reads the cached string descriptors, e.g. after swapping boards between ports
+    '''
+    devices = []
+    for device in usb.core.find(backend=_get_backend(), find_all=True, idVendor=VENDOR_ID, idProduct=PRODUCT_ID):
+        try:
+            manufacturer, product = _descriptors(device, refresh)
+        except (usb.core.USBError, ValueError):
+            continue
+        if manufacturer == "www.dcttech.com" and product.startswith("USBRelay"):
+            devices.append(device)
+    return devices
+
+
+class RelayBank(object):
+    """
+    Several USB relay boards behind one flat channel space
+
+    Boards are addressed by the 5 character serial stored on the board (set_serial), channels by
+    the names from each board's config file ([RELAY_CHANNELS]) or as "SERIAL:n". A name used on
+    more than one board is only reachable as "SERIAL:n".
+
+        bank = RelayBank({"AB12C": "EEequipment/usbrelay/fixture_a.ini", "XY34Z": None})
+        bank.apply({"ARDUINO": 1, "XY34Z:3": 0})
+
+    Switching that touches several boards runs one thread per board
+    """
+
+    def __init__(self, configs=None, timeout=5000):
+        configs = configs or {}
+        self.boards = {}
+        self.channels = {}
+        self._locks = {}
+
+        for device in find_all():
+            # the serial is only known after the board has been read, so configure it afterwards
+            board = USBRelayController(device, timeout, config_file=None)
+            if board.serial in self.boards:
+                print(f"RelayBank: two boards with serial {board.serial}, ignoring the second (use set_serial)")
+                continue
+            config_file = configs.get(board.serial)
+            if config_file is not None:
+                board.configure(config_file)
+            self.boards[board.serial] = board
+            self._locks[board.serial] = threading.Lock()
+
+        missing = set(configs) - set(self.boards)
+        if missing:
+            print(f"RelayBank: boards not found: {', '.join(sorted(missing))}")
+        self._build_channels()
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(len(self.boards), 1),
+                                                               thread_name_prefix="RelayBank")
+        print(f"RelayBank: {len(self.boards)} boards, {len(self.channels)} named channels")
+
+    def _build_channels(self):
+        seen = {}
+        for serial, board in self.boards.items():
+            for i in range(1, board.num_relays + 1):
+                name = board.relay_mapping.get(f'channel_{i}')
+                if name:
+                    seen.setdefault(name, []).append((serial, i))
+        for name, owners in seen.items():
+            if len(owners) == 1:
+                self.channels[name] = owners[0]
+            else:
+                print(f"RelayBank: channel name {name} is used on {len(owners)} boards, use SERIAL:n for it")
+
+    def resolve(self, channel):
+        '''
+        (serial, relay number) for a channel name or "SERIAL:n"
+        '''
+        if channel in self.channels:
+            return self.channels[channel]
+        serial, sep, num = str(channel).partition(":")
+        if sep and serial in self.boards and num.isdigit():
+            return serial, int(num)
+        raise KeyError(f"Unknown relay channel: {channel}")
+
+    def _run(self, work):
+        # work: {serial: fn(board)}, one thread per board when more than one board is involved
+        def locked(serial, fn):
+            with self._locks[serial]:
+                return fn(self.boards[serial])
+
+        if len(work) == 1:
+            serial, fn = next(iter(work.items()))
+            return {serial: locked(serial, fn)}
+        futures = {serial: self._executor.submit(locked, serial, fn) for serial, fn in work.items()}
+        return {serial: future.result() for serial, future in futures.items()}
+
+    def apply(self, states, allow_glitch=False):
+        '''
+        Set channels from {channel: state}, grouped per board, boards switched in parallel
+        Returns {serial: USB transfers used}
+        '''
+        per_board = {}
+        for channel, state in states.items():
+            serial, num = self.resolve(channel)
+            per_board.setdefault(serial, {})[num] = state
+        return self._run({serial: (lambda board, s=board_states: board.apply(s, allow_glitch))
+                          for serial, board_states in per_board.items()})
+
+    def set_state(self, channel, state):
+        return self.apply({channel: state})
+
+    def get_state(self, channel, refresh=False):
+        serial, num = self.resolve(channel)
+        with self._locks[serial]:
+            return self.boards[serial].get_state(num, refresh)
+
+    def __getitem__(self, channel):
+        return self.get_state(channel)
+
+    def __setitem__(self, channel, state):
+        self.set_state(channel, state)
+
+    def get_states(self):
+        '''
+        {channel name: state} for every named channel, from the cached registers
+        '''
+        return {name: self.get_state(name) for name in self.channels}
+
+    def refresh(self):
+        return self._run({serial: (lambda board: board.refresh()) for serial in self.boards})
+
+    def open_all(self):
+        self._run({serial: (lambda board: board.open_all()) for serial in self.boards})
+
+    def close_all(self):
+        self._run({serial: (lambda board: board.close_all()) for serial in self.boards})
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        for board in self.boards.values():
+            usb.util.dispose_resources(board.device)
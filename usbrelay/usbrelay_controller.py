@@ -3,6 +3,7 @@
 # SPDX-License-Identifier: MIT
 
 import array
+import collections
 import os
 import usb.core
 import usb.util
@@ -22,27 +23,33 @@ def xor(a, b):
     return bool(a) != bool(b)
 
 
+# a named set of signal connections compiled to relay bitmasks: care is every relay the route
+# defines (all relays with a channel name), drive is the relay pattern that makes exactly the
+# listed signals connected (taking NO/NC wiring into account)
+Route = collections.namedtuple("Route", ["name", "signals", "care", "drive"])
+
+
 VENDOR_ID = 0x16C0
 PRODUCT_ID = 0x05DF
 
 
 
 
-def find():
-    def _get_backend():
-        import os
-        if os.name != "nt":
-            return None
+def _get_backend():
+    if os.name != "nt":
+        return None
 
-        import usb.backend.libusb1
-        import libusb
-        import pathlib
+    import usb.backend.libusb1
+    import libusb
+    import pathlib
 
-        # Manually find the libusb DLL and create a backend using it. I don't know
-        # why Python can't find this on its own
-        libpath = next(pathlib.Path(libusb.__file__).parent.rglob("x64/libusb-1.0.dll"))
-        return usb.backend.libusb1.get_backend(find_library=lambda x: str(libpath))
+    # Manually find the libusb DLL and create a backend using it. I don't know
+    # why Python can't find this on its own
+    libpath = next(pathlib.Path(libusb.__file__).parent.rglob("x64/libusb-1.0.dll"))
+    return usb.backend.libusb1.get_backend(find_library=lambda x: str(libpath))
 
+
+def find():
     class MatchUSBRelay(object):
         def __call__(self, device):
             manufacturer = usb.util.get_string(device, device.iManufacturer)
@@ -77,10 +84,15 @@ def find():
 # bit 0/1/2/3/4/5/6/7/8 indicate relay 1/2/3/4/5/6/7/8 status
 
 
+CONFIG_FILE_PATH = "EEequipment/usbrelay/config.ini"
+
+
 class USBRelayController(object):
-    def __init__(self, device, timeout=5000):
+    def __init__(self, device, timeout=5000, config_file=CONFIG_FILE_PATH):
         self.device = device
         self.timeout = timeout
+        self.state = 0  # cached relay register (bit 0 = relay 1), kept up to date by our own writes
+        self.transfer_count = 0
 
         if self.device is not None:
             self.product = usb.util.get_string(device, device.iProduct)
@@ -95,19 +107,30 @@ class USBRelayController(object):
         self.aliases = {}
         self.defaults = {}
         self.relay_mapping = {}
-
-        # set relay mapping / configuration
-        config_file_path = "EEequipment/usbrelay/config.ini"
-        if os.path.exists(config_file_path):
-            self.read_relay_config(config_file_path)
+        self.signal_index = {}  # signal name -> relay number
+        self.routes = {}
+
+        # set relay mapping / configuration (config_file=None runs without one)
+        if config_file is not None:
+            self.configure(config_file)
+
+    def configure(self, config_file):
+        '''
+        Read the relay mapping from config_file and switch on the relays marked ON at startup
+        '''
+        if os.path.exists(config_file):
+            self.read_relay_config(config_file)
         else:
-            print(f"Configuration file {config_file_path} does not exist.")
+            print(f"Configuration file {config_file} does not exist.")
             raise BaseException
 
-        # set startup on/off states based on config file
+        # set startup on/off states based on config file, as one mask
+        startup = {}
         for i in range(1, self.num_relays + 1):
-            if self.relay_mapping[f'startup_{i}'] == "ON":
-                self.set_state(i, 1)
+            if self.relay_mapping.get(f'startup_{i}') == "ON":
+                startup[i] = 1
+        if startup and self.status:
+            self.apply(startup)
 
     def read_relay_config(self, config_file):
         config = configparser.ConfigParser()
@@ -122,6 +145,19 @@ class USBRelayController(object):
             if config.has_option('RELAY_STARTUP', channel_key):
                 self.relay_mapping[f'startup_{i}'] = config.get('RELAY_STARTUP', channel_key)
 
+        self.signal_index = {}
+        for i in range(1, self.num_relays + 1):
+            signal = self.relay_mapping.get(f'channel_{i}')
+            if signal:
+                self.signal_index[signal] = i
+
+        # [ROUTES] name = SIGNAL_A, SIGNAL_B (the signals connected in that route, the rest disconnected)
+        self.routes = {}
+        if config.has_section('ROUTES'):
+            for name, value in config.items('ROUTES'):
+                signals = [signal.strip() for signal in value.split(",") if signal.strip()]
+                self.routes[name] = self.compile_route(name, signals)
+
     def print_relay_mappings(self):
         for channel, connection in self.relay_mapping.items():
             if connection:
@@ -137,9 +173,69 @@ class USBRelayController(object):
 
     def return_channel(self, mapping):
         # returns the channel number for a certain "mapping" string
-        channel = next((channel for channel, device in self.relay_mapping.items() if device == mapping), None)
+        channel = self.signal_index.get(mapping)
         print(f'The channel for {mapping} is: {channel}')
-        return int(channel[-1])
+        if channel is None:
+            raise KeyError(f"No relay channel is mapped to {mapping}")
+        return channel
+
+    def _nc_mask(self):
+        # relays wired normally closed: the signal is connected when the relay is NOT driven
+        mask = 0
+        for i in range(1, self.num_relays + 1):
+            if self.relay_mapping.get(f'state_{i}') == "NC":
+                mask |= 1 << (i - 1)
+        return mask
+
+    def compile_route(self, name, signals):
+        '''
+        Build a Route from the list of signals that should be connected
+        '''
+        care = 0
+        for relay in self.signal_index.values():
+            care |= 1 << (relay - 1)
+        connected = 0
+        for signal in signals:
+            if signal not in self.signal_index:
+                raise ValueError(f"Route {name}: no relay channel is mapped to {signal}")
+            connected |= 1 << (self.signal_index[signal] - 1)
+        return Route(name, tuple(signals), care, (connected ^ self._nc_mask()) & care)
+
+    def add_route(self, name, signals):
+        self.routes[name] = self.compile_route(name, signals)
+        return self.routes[name]
+
+    def active_route(self):
+        '''
+        Name of the route the relays are currently in (from the cache), None if no route matches
+        '''
+        mask = self.get_mask()
+        for name, route in self.routes.items():
+            if mask & route.care == route.drive:
+                return name
+        return None
+
+    def switch_route(self, name):
+        '''
+        Switch to a route touching only the relays that change, break-before-make: every
+        connection that goes away is broken first, then the new ones are made
+        Returns the number of USB transfers used
+        '''
+        route = self.routes[name]
+        current = self.get_mask()
+        target = (current & ~route.care) | route.drive
+        changed = current ^ target
+        if not changed:
+            return 0
+
+        # relays whose signal goes from connected to disconnected
+        connected_now = current ^ self._nc_mask()
+        breaking = changed & connected_now
+        transfers = 0
+        if breaking:
+            transfers += self.set_mask(current ^ breaking)
+        transfers += self.set_mask(target)
+        return transfers
 
     def get_property(self, relay, name, default=None):
         value = self.defaults.get(name, default)
@@ -158,6 +254,13 @@ class USBRelayController(object):
 
         self._update_status()
 
+    def refresh(self):
+        '''
+        Re-read the relay register from the board (only needed if something else switched the relays)
+        '''
+        self._update_status()
+        return self.state
+
     def _update_status(self):
         data = self._get_hid_report(MAIN_REPORT, 8)
         try:
@@ -194,8 +297,10 @@ class USBRelayController(object):
         relay_num = self._name_to_number(relay)
         return relay_num - 1
 
-    def get_state(self, relay):
-        self._update_status()
+    def get_state(self, relay, refresh=False):
+        # from the cached register unless refresh is asked for
+        if refresh:
+            self._update_status()
         idx = self._name_to_index(relay)
         invert = self.get_property(relay, "invert", False)
 
@@ -219,31 +324,106 @@ class USBRelayController(object):
         return False
 
     def set_state(self, relay, state):
-        buf = array.array("B")
         invert = self.get_property(relay, "invert", False)
         if relay == "all":
-            buf.append(0xFE if xor(state, invert) else 0xFC)
+            self._write_register(0xFE if xor(state, invert) else 0xFC)
         else:
             relay_num = self._name_to_number(relay)
-            buf.append(0xFF if xor(state, invert) else 0xFD)
-            buf.append(relay_num)
+            self._write_register(0xFF if xor(state, invert) else 0xFD, relay_num)
 
+    def _full_mask(self):
+        return (1 << self.num_relays) - 1
+
+    def _invert_mask(self):
+        # relays whose logical state is the inverse of the register bit
+        mask = 0
+        for i in range(1, self.num_relays + 1):
+            if self.get_property(i, "invert", False):
+                mask |= 1 << (i - 1)
+        return mask
+
+    def get_mask(self):
+        '''
+        Logical state of every relay as a bitmask (bit 0 = relay 1), from the cache
+        '''
+        return (self.state ^ self._invert_mask()) & self._full_mask()
+
+    def set_mask(self, mask, allow_glitch=False):
+        '''
+        Switch every relay to the logical bitmask (bit 0 = relay 1) with as few USB transfers as
+        possible: nothing if the cache already matches, one all on/all off (0xFE/0xFC) transfer
+        if the target is uniform, otherwise one transfer per relay that changes (offs first)
+        With allow_glitch an all on/off followed by the exceptions is used when that is shorter,
+        at the cost of the untouched relays briefly switching
+        Returns the number of transfers used
+        '''
+        full = self._full_mask()
+        target = (mask ^ self._invert_mask()) & full
+        current = self.state & full
+        if target == current:
+            return 0
+        if target == full or target == 0:
+            self._write_register(0xFE if target == full else 0xFC)
+            return 1
+
+        changed = target ^ current
+        plans = [(bin(changed).count("1"), None)]
+        if allow_glitch:
+            plans.append((1 + bin(full & ~target).count("1"), 0xFE))
+            plans.append((1 + bin(target).count("1"), 0xFC))
+        count, all_cmd = min(plans, key=lambda plan: plan[0])
+
+        if all_cmd is not None:
+            self._write_register(all_cmd)
+            changed = target ^ self.state
+        for i in range(self.num_relays):
+            if changed & (1 << i) and not target & (1 << i):
+                self._write_register(0xFD, i + 1)
+        for i in range(self.num_relays):
+            if changed & (1 << i) and target & (1 << i):
+                self._write_register(0xFF, i + 1)
+        return count
+
+    def apply(self, states, allow_glitch=False):
+        '''
+        Set several relays at once from {relay: state}, other relays keep their state
+        '''
+        mask = self.get_mask()
+        for relay, state in states.items():
+            relay_num = self._name_to_number(relay)
+            bit = 1 << (relay_num - 1)
+            # an alias can carry its own invert, the mask is in terms of the relay number
+            energized = xor(state, self.get_property(relay, "invert", False))
+            if xor(energized, self.get_property(relay_num, "invert", False)):
+                mask |= bit
+            else:
+                mask &= ~bit
+        return self.set_mask(mask, allow_glitch)
+
+    def _write_register(self, cmd, relay_num=None):
+        # raw register write (no invert handling) that keeps the cache in step
+        buf = array.array("B", [cmd] if relay_num is None else [cmd, relay_num])
         self._set_hid_report(MAIN_REPORT, buf)
+        if cmd == 0xFE:
+            self.state = self._full_mask()
+        elif cmd == 0xFC:
+            self.state = 0
+        elif cmd == 0xFF:
+            self.state |= 1 << (relay_num - 1)
+        elif cmd == 0xFD:
+            self.state &= ~(1 << (relay_num - 1))
 
     def toggle_state(self, relay):
         if relay == "all":
-            for i in range(1, self.num_relays + 1):
-                self.set_state(i, not self.get_state(i))
+            self.set_mask(self.get_mask() ^ self._full_mask())
         else:
             self.set_state(relay, not self.get_state(relay))
 
     def open_all(self):
-        for i in range(1, self.num_relays+ 1):
-            self.set_state(i, 0)
+        self.set_mask(0)
 
     def close_all(self):
-        for i in range(1, self.num_relays + 1):
-            self.set_state(i, 1)
+        self.set_mask(self._full_mask())
 
     def __getitem__(self, relay):
         return self.get_state(relay)
@@ -252,6 +432,7 @@ class USBRelayController(object):
         self.set_state(relay, state)
 
     def _get_hid_report(self, report, size):
+        self.transfer_count += 1
         return self.device.ctrl_transfer(
             USB_TYPE_CLASS | USB_RECIP_DEVICE | USB_ENDPOINT_IN,
             GET_REPORT,
@@ -266,6 +447,7 @@ class USBRelayController(object):
         while len(data) < 8:
             data.append(0x00)
 
+        self.transfer_count += 1
         return self.device.ctrl_transfer(
             USB_TYPE_CLASS | USB_RECIP_DEVICE | USB_ENDPOINT_OUT,
             SET_REPORT,
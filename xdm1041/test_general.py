@@ -27,9 +27,8 @@ if __name__ == "__main__":
         while True:
             time.sleep(0.5)
 
-            # read the raw float value
-            val_raw: float = xdm.read_val1_raw()
-            val_str: str = xdm.read_val1_str().replace('\n', '').replace('\r', '')
+            # read the raw float value and the formatted value in one exchange
+            val_raw, _, val_str = xdm.read_values()
 
             print("Timestamp:{} Formatted value:{} Raw value:{}".format(
                 int(time.time() * 1000),
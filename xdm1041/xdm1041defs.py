@@ -19,39 +19,26 @@ class XDM1041Mode(Enum):
     MODE_TEMP = 12
 
     def __str__(self):
+        return MODE_STR[self]
 
-        if self.value == XDM1041Mode.MODE_VOLTAGE_DC.value:
-            return "CONF:VOLT:DC\n"
+    def __bytes__(self):
+        return MODE_BYTES[self]
 
-        elif self.value == XDM1041Mode.MODE_VOLTAGE_AC.value:
-            return "CONF:VOLT:AC\n"
 
-        elif self.value == XDM1041Mode.MODE_CURRENT_DC.value:
-            return "CONF:CURR:DC\n"
-
-        elif self.value == XDM1041Mode.MODE_CURRENT_AC.value:
-            return "CONF:CURR:AC\n"
-
-        elif self.value == XDM1041Mode.MODE_RES.value:
-            return "CONF:RES\n"
-
-        elif self.value == XDM1041Mode.MODE_CONT.value:
-            return "CONF:CONT\n"
-
-        elif self.value == XDM1041Mode.MODE_DIODE.value:
-            return "CONF:DIOD\n"
-
-        elif self.value == XDM1041Mode.MODE_CAPACITANCE.value:
-            return "CONF:CAP\n"
-
-        elif self.value == XDM1041Mode.MODE_FREQUENCY.value:
-            return "CONF:FREQ\n"
-
-        elif self.value == XDM1041Mode.MODE_PERIOD.value:
-            return "CONF:PER\n"
-
-        elif self.value == XDM1041Mode.MODE_TEMP.value:
-            return "CONF:TEMP\n"
+# FUNC1? responses (quotes and a trailing " DC" stripped) back to the mode
+FUNC_RESPONSE_MODE = {
+    "VOLT": XDM1041Mode.MODE_VOLTAGE_DC,
+    "VOLT AC": XDM1041Mode.MODE_VOLTAGE_AC,
+    "CURR": XDM1041Mode.MODE_CURRENT_DC,
+    "CURR AC": XDM1041Mode.MODE_CURRENT_AC,
+    "RES": XDM1041Mode.MODE_RES,
+    "CONT": XDM1041Mode.MODE_CONT,
+    "DIOD": XDM1041Mode.MODE_DIODE,
+    "CAP": XDM1041Mode.MODE_CAPACITANCE,
+    "FREQ": XDM1041Mode.MODE_FREQUENCY,
+    "PER": XDM1041Mode.MODE_PERIOD,
+    "TEMP": XDM1041Mode.MODE_TEMP,
+}
 
 
 class XDM1041Cmd(Enum):
@@ -90,76 +77,99 @@ class XDM1041Cmd(Enum):
     GET_RANGE = 57
 
     def __str__(self):
-        if self.value == XDM1041Cmd.IDN.value:
-            return "*IDN?\n"
-
-        elif self.value == XDM1041Cmd.RATE_S.value:
-            return "RATE S\n"
-
-        elif self.value == XDM1041Cmd.RATE_M.value:
-            return "RATE M\n"
-
-        elif self.value == XDM1041Cmd.RATE_F.value:
-            return "RATE F\n"
-
-        elif self.value == XDM1041Cmd.MEASURE_1.value:
-            return "MEAS1:SHOW?\n"
-
-        elif self.value == XDM1041Cmd.MEASURE_2.value:
-            return "MEAS2:SHOW?\n"
-
-        elif self.value == XDM1041Cmd.MEASURE_1_RAW.value:
-            return "MEAS1?\n"
-
-        elif self.value == XDM1041Cmd.MEASURE_2_RAW.value:
-            return "MEAS2?\n"
-
-        elif self.value == XDM1041Cmd.SET_RANGE.value:
-            return "RANGE {}\n"
-
-        elif self.value == XDM1041Cmd.SET_BEEP_ON.value:
-            return "SYST:BEEP:STAT ON\n"
-
-        elif self.value == XDM1041Cmd.SET_BEEP_OFF.value:
-            return "SYST:BEEP:STAT OFF\n"
-
-        elif self.value == XDM1041Cmd.GET_BEEP_STATUS.value:
-            return "SYST:BEEP:STAT?\n"
-
-        elif self.value == XDM1041Cmd.GET_SYSTEM_DATE.value:
-            return "SYST:DATE?\n"
-
-        elif self.value == XDM1041Cmd.GET_SYSTEM_TIME.value:
-            return "SYST:TIME?\n"
-
-        elif self.value == XDM1041Cmd.SET_AUTO_MODE.value:
-            return "AUTO\n"
-
-        elif self.value == XDM1041Cmd.GET_AUTO_MODE.value:
-            return "AUTO?\n"
-
-        elif self.value == XDM1041Cmd.SET_CALC_STAT_OFF.value:
-            return "CALC:STAT OFF\n"
-
-        elif self.value == XDM1041Cmd.SET_CALC_FUNC_AVG.value:
-            return "CALC:FUNC AVER\n"
-
-        elif self.value == XDM1041Cmd.GET_CALC_AVG.value:
-            return "CALC:FUNC AVER\n"
-
-        elif self.value == XDM1041Cmd.SET_CALC_FUNC_AVG.value:
-            return "CALC:AVER:AVER?\n"
-
-        elif self.value == XDM1041Cmd.SET_CALC_FUNC_AVG.value:
-            return "CALC:FUNC AVER\n"
-
-        elif self.value == XDM1041Cmd.FUNC1.value:
-            return "FUNC1?"
-
-        elif self.value == XDM1041Cmd.FUNC2.value:
-            return "FUNC2?"
-
-        elif self.value == XDM1041Cmd.GET_RANGE.value:
-            return "RANGE?"
+        return CMD_STR[self]
+
+    def __bytes__(self):
+        return encode_cmd(self)
+
+
+##################################
+#### command tables  #############
+##################################
+MODE_STR = {
+    XDM1041Mode.MODE_VOLTAGE_DC: "CONF:VOLT:DC\n",
+    XDM1041Mode.MODE_VOLTAGE_AC: "CONF:VOLT:AC\n",
+    XDM1041Mode.MODE_CURRENT_DC: "CONF:CURR:DC\n",
+    XDM1041Mode.MODE_CURRENT_AC: "CONF:CURR:AC\n",
+    XDM1041Mode.MODE_RES: "CONF:RES\n",
+    XDM1041Mode.MODE_CONT: "CONF:CONT\n",
+    XDM1041Mode.MODE_DIODE: "CONF:DIOD\n",
+    XDM1041Mode.MODE_CAPACITANCE: "CONF:CAP\n",
+    XDM1041Mode.MODE_FREQUENCY: "CONF:FREQ\n",
+    XDM1041Mode.MODE_PERIOD: "CONF:PER\n",
+    XDM1041Mode.MODE_TEMP: "CONF:TEMP\n",
+}
+
+CMD_STR = {
+    XDM1041Cmd.IDN: "*IDN?\n",
+    XDM1041Cmd.RATE_S: "RATE S\n",
+    XDM1041Cmd.RATE_M: "RATE M\n",
+    XDM1041Cmd.RATE_F: "RATE F\n",
+    XDM1041Cmd.MEASURE_1: "MEAS1:SHOW?\n",
+    XDM1041Cmd.MEASURE_2: "MEAS2:SHOW?\n",
+    XDM1041Cmd.MEASURE_1_RAW: "MEAS1?\n",
+    XDM1041Cmd.MEASURE_2_RAW: "MEAS2?\n",
+    XDM1041Cmd.SET_RANGE: "RANGE {}\n",
+    XDM1041Cmd.SET_BEEP_ON: "SYST:BEEP:STAT ON\n",
+    XDM1041Cmd.SET_BEEP_OFF: "SYST:BEEP:STAT OFF\n",
+    XDM1041Cmd.GET_BEEP_STATUS: "SYST:BEEP:STAT?\n",
+    XDM1041Cmd.GET_SYSTEM_TIME: "SYST:TIME?\n",
+    XDM1041Cmd.GET_SYSTEM_DATE: "SYST:DATE?\n",
+    XDM1041Cmd.GET_AUTO_MODE: "AUTO?\n",
+    XDM1041Cmd.SET_AUTO_MODE: "AUTO\n",
+    XDM1041Cmd.SET_CALC_STAT_OFF: "CALC:STAT OFF\n",
+    XDM1041Cmd.SET_CALC_FUNC_AVG: "CALC:FUNC AVER\n",
+    XDM1041Cmd.GET_CALC_AVG: "CALC:AVER:AVER?\n",
+    XDM1041Cmd.GET_CALC_MIN: "CALC:AVER:MIN?\n",
+    XDM1041Cmd.GET_CALC_MAX: "CALC:AVER:MAX?\n",
+    XDM1041Cmd.FUNC1: "FUNC1?\n",
+    XDM1041Cmd.FUNC2: "FUNC2?\n",
+    XDM1041Cmd.GET_RANGE: "RANGE?\n",
+}
+
+# commands that take a parameter are stored as a bytes %-template instead
+CMD_TEMPLATE = {
+    XDM1041Cmd.SET_RANGE: b"RANGE %d\n",
+}
+
+# pre-encoded once at import so sending a command is a dict lookup and a write
+MODE_BYTES = {mode: cmd.encode("ascii") for mode, cmd in MODE_STR.items()}
+CMD_BYTES = {cmd: s.encode("ascii") for cmd, s in CMD_STR.items() if cmd not in CMD_TEMPLATE}
+
+
+def encode_cmd(cmd: XDM1041Cmd, *args) -> bytes:
+    """
+    Return the wire bytes for a command, filling in the parameters of templated commands
+    """
+    if cmd in CMD_TEMPLATE:
+        if not args:
+            raise ValueError(f"{cmd.name} takes a parameter, use encode_cmd(XDM1041Cmd.{cmd.name}, value)")
+        return CMD_TEMPLATE[cmd] % args
+    return CMD_BYTES[cmd]
 
 
+def validate_tables():
+    """
+    Check every enum member has exactly one table entry ending in a single line terminator
+    """
+    def check(name, member, wire):
+        if wire.count(b"\n") != 1 or not wire.endswith(b"\n"):
+            raise ValueError(f"{name}: command for {member.name} is not terminated correctly: {wire!r}")
+
+    for mode in XDM1041Mode:
+        if mode not in MODE_BYTES:
+            raise ValueError(f"MODE_BYTES: no command for {mode.name}")
+        check("MODE_BYTES", mode, MODE_BYTES[mode])
+
+    for cmd in XDM1041Cmd:
+        if cmd not in CMD_STR:
+            raise ValueError(f"CMD_STR: no command for {cmd.name}")
+        if cmd in CMD_TEMPLATE:
+            check("CMD_TEMPLATE", cmd, CMD_TEMPLATE[cmd])
+        elif cmd not in CMD_BYTES:
+            raise ValueError(f"CMD_BYTES: no command for {cmd.name}")
+        else:
+            check("CMD_BYTES", cmd, CMD_BYTES[cmd])
+
+
+validate_tables()
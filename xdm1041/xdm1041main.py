@@ -7,12 +7,27 @@
 # import modules
 import logging
 import serial
-import time
+import threading
 
 # import user created modules
 from EEequipment.Equipment import Equipment
-from EEequipment.xdm1041.xdm1041defs import XDM1041Mode, XDM1041Cmd
-from EEequipment.xdm1041 import xdm1041helper
+from EEequipment.SCPI import SCPIFrameReader, SCPITransaction
+from EEequipment.xdm1041.xdm1041defs import XDM1041Mode, XDM1041Cmd, FUNC_RESPONSE_MODE
+from EEequipment.xdm1041.xdm1041defs import CMD_BYTES, MODE_BYTES, encode_cmd
+from EEequipment.xdm1041 import xdm1041settle
+from EEequipment.xdm1041.xdm1041stream import XDM1041Stream
+
+
+class _XDM1041Transaction(SCPITransaction):
+    """
+    SCPITransaction that also accepts XDM1041Cmd members and maps them to their pre-encoded bytes
+    """
+
+    @staticmethod
+    def _to_bytes(cmd):
+        if isinstance(cmd, XDM1041Cmd):
+            cmd = encode_cmd(cmd)
+        return SCPITransaction._to_bytes(cmd)
 
 
 class XDM1041(Equipment):
@@ -34,6 +49,14 @@ class XDM1041(Equipment):
         XDM1041Mode.MODE_TEMP: rng_tmp
     }
 
+    # time between display updates for each sample rate (s, on the safe side). MEAS1? only
+    # returns a new value once per update, polling faster just re-reads the last conversion
+    rate_period = {
+        XDM1041Cmd.RATE_S: 0.5,
+        XDM1041Cmd.RATE_M: 0.2,
+        XDM1041Cmd.RATE_F: 0.05,
+    }
+
     @classmethod
     def show_available_ranges(cls):
         for xdm_mode in cls.range_ref_dict.keys():
@@ -45,7 +68,15 @@ class XDM1041(Equipment):
 
     def __init__(self, serial_device, mode: XDM1041Mode):
         super().__init__()
-        self.mode = mode
+
+        # shadow copy of the meter state so redundant writes can be skipped, None means unknown
+        self.mode = None
+        self.range = None
+        self.auto_range = None
+        self.rate = None
+
+        self.lock = threading.RLock()  # one command/response exchange at a time
+        self.last_settle = None  # SettleResult of the most recent wait_settled()
         try:
             self.serial = serial.Serial(
                 port=serial_device,
@@ -61,49 +92,172 @@ class XDM1041(Equipment):
         except serial.serialutil.SerialException:
             self.serial = None
             self.status = False
+        self.timeout = 0.5
+        self._reader = SCPIFrameReader(self.serial, b'\n') if self.serial else None
 
         self.logger = logging.getLogger(__name__) # TODO: understand this logger thing
         self.logger.info("Serial port status:{}".format(self.status))
+        self.resync()
+        self.set_mode(mode)
         self.set_range_auto()
 
     # test_conn: queries IDN
     def test_conn(self) -> str:
-        cmd = str(XDM1041Cmd.IDN)
-        self.send_cmd(cmd)
-        time.sleep(0.2)
-        idn_info = self.read_result()
+        idn_info = self.query(XDM1041Cmd.IDN)
         return idn_info
 
     def connect(self):
         if self.serial and self.serial.is_open is False:
             self.serial.open()
 
-    def send_cmd(self, cmd: str):
+    def send_cmd(self, cmd):
         """
-        Take one of the string commands and encode it and send it over the wire
+        Send a command over the wire. Takes the pre-encoded bytes from the command tables
+        (xdm1041defs.CMD_BYTES / MODE_BYTES / encode_cmd), a plain string is encoded here
         """
         if self.status:
-            self.serial.write(cmd.encode())
+            if isinstance(cmd, str):
+                cmd = cmd.encode()
+            self.serial.write(cmd)
 
     def read_result(self):
         """
         Not too much to do here, all the output from the instrument are ascii strings with linefeed
-        just read a line and return
+        just read a line and return it without the line ending ('' on timeout)
         """
         if self.status:
-            ret_str = self.serial.readline()
+            frame = self._reader.read_frame(self.timeout)
+            if frame is None:
+                return ''
+            return frame.decode(errors="backslashreplace").strip()
+
+    def _drain(self):
+        # drop a late reply from an earlier query, otherwise every later query is off by one
+        if self.status:
+            self._reader.reset()
+
+    def query(self, cmd: XDM1041Cmd) -> str:
+        """
+        Send a query and read its response as one exchange, safe to call from several threads
+        """
+        with self.lock:
+            self._drain()
+            self.send_cmd(encode_cmd(cmd))
+            return self.read_result()
+
+    def query_async(self, cmd: XDM1041Cmd):
+        """
+        Send a query now and return a function that reads its response later, so other work
+        (e.g. moving a supply to the next setpoint) can overlap the meter's reply
+        The meter stays locked until the returned function is called
+        """
+        self.lock.acquire()
+        try:
+            self._drain()
+            self.send_cmd(encode_cmd(cmd))
+        except BaseException:
+            self.lock.release()
+            raise
+
+        def finish() -> str:
             try:
-                ret_str.decode()
-            except UnicodeDecodeError:
-                return ret_str
+                return self.read_result()
             finally:
-                return ret_str.decode()
+                self.lock.release()
+        return finish
+
+    def transaction(self, joined=False) -> SCPITransaction:
+        """
+        Pipelined exchange: queue queries (XDM1041Cmd or bytes) with optional parse functions,
+        they are written in one burst and the responses read back in order, e.g.
+
+            with xdm.transaction() as tr:
+                tr.query(XDM1041Cmd.MEASURE_1_RAW, float)
+                tr.query(XDM1041Cmd.MEASURE_1)
+            val_raw, val_str = tr.results
+
+        The meter lock is held for the exchange, a missing response raises TimeoutError
+        """
+        return _XDM1041Transaction(self._write_raw, self._reader, self.timeout, joined, self.lock)
+
+    def _write_raw(self, data: bytes):
+        if self.status:
+            self.serial.write(data)
+
+    def read_values(self):
+        """
+        Read raw measurement 1, raw measurement 2 and formatted measurement 1 in one exchange
+        All None if the exchange timed out
+        """
+        def to_float(val_str):
+            try:
+                return float(val_str)
+            except ValueError:
+                return None
+
+        if not self.status:
+            return None, None, None
+        tr = self.transaction()
+        tr.query(XDM1041Cmd.MEASURE_1_RAW, to_float)
+        tr.query(XDM1041Cmd.MEASURE_2_RAW, to_float)
+        tr.query(XDM1041Cmd.MEASURE_1)
+        try:
+            return tuple(tr.execute())
+        except TimeoutError as e:
+            self.logger.warning(str(e))
+            return None, None, None
+
+    def sync(self):
+        """
+        Round trip a query so we know the meter has processed every command sent before it
+        """
+        return self.query(XDM1041Cmd.IDN)
 
     def disconnect(self):
         if self.serial and self.serial.is_open:
             self.serial.close()
 
-    def set_range(self, rng: int) -> bool:
+    def invalidate_state(self):
+        """
+        Forget the shadow state, the next setter call will always be sent
+        """
+        self.mode = None
+        self.range = None
+        self.auto_range = None
+        self.rate = None
+
+    def resync(self):
+        """
+        Re-read mode, range and auto-range from the meter into the shadow state.
+        The sample rate can't be queried so it is marked unknown
+        """
+        self.invalidate_state()
+        if not self.status:
+            return
+        func = self.get_func1()
+        if func:
+            func = func.strip().strip('"').upper().replace(":", " ")
+            if func.endswith(" DC"):
+                func = func[:-3]
+            self.mode = FUNC_RESPONSE_MODE.get(func)
+
+        auto = self.get_range_auto()
+        if auto:
+            auto = auto.strip().strip('"').upper()
+            if auto in ("1", "ON"):
+                self.auto_range = True
+            elif auto in ("0", "OFF"):
+                self.auto_range = False
+
+        rng = self.get_range()
+        if rng and self.mode in XDM1041.range_ref_dict:
+            rng = rng.strip().strip('"')
+            for key, value in XDM1041.range_ref_dict[self.mode].items():
+                if rng == str(key) or rng.upper() == value.upper():
+                    self.range = key
+                    break
+
+    def set_range(self, rng: int, force=False) -> bool:
         """
         We must first detect the mode, then ensure the range is within the allowed values
         Name        Type        Range
@@ -117,7 +271,7 @@ class XDM1041(Equipment):
                                 TEMP 1(KITS90),2(PT100)
         """
         if self.mode not in XDM1041.range_ref_dict:
-            self.logger.error("Selected mode:{} does not support range selection!".format(self.mode.name))
+            self.logger.error("Selected mode:{} does not support range selection!".format(self.mode))
             return False
 
         range_dict = XDM1041.range_ref_dict[self.mode]
@@ -125,46 +279,47 @@ class XDM1041(Equipment):
             self.logger.error("Selected range: {} is not supported!".format(rng))
             return False
 
+        # already there, nothing to send
+        if not force and self.auto_range is False and self.range == rng:
+            return True
+
         # we made it, set the range
-        cmd = str(XDM1041Cmd.SET_RANGE).format(rng)
-        print(f"\tsetting DMM range with cmd: {cmd}")
+        cmd = encode_cmd(XDM1041Cmd.SET_RANGE, rng)
+        print(f"\tsetting DMM range with cmd: {cmd.decode().strip()}")
         self.send_cmd(cmd)
-
-    def set_range_auto(self):
-        cmd = str(XDM1041Cmd.SET_AUTO_MODE)
+        self.range = rng
+        self.auto_range = False
+        return True
+
+    def set_range_auto(self, force=False):
+        if not force and self.auto_range is True:
+            return
+        cmd = CMD_BYTES[XDM1041Cmd.SET_AUTO_MODE]
         self.send_cmd(cmd)
+        self.range = None
+        self.auto_range = True
 
     def get_range_auto(self):
-        cmd = str(XDM1041Cmd.GET_AUTO_MODE)
-        self.send_cmd(cmd)
-        result = self.read_result()
+        result = self.query(XDM1041Cmd.GET_AUTO_MODE)
         return result
 
     def get_range(self):
-        cmd = str(XDM1041Cmd.GET_RANGE)
-        self.send_cmd(cmd)
-        result = self.read_result()
+        result = self.query(XDM1041Cmd.GET_RANGE)
         return result
 
     def get_func1(self):
-        cmd = str(XDM1041Cmd.FUNC1)
-        self.send_cmd(cmd)
-        result = self.read_result()
+        result = self.query(XDM1041Cmd.FUNC1)
         return result
 
     def get_func2(self):
-        cmd = str(XDM1041Cmd.FUNC2)
-        self.send_cmd(cmd)
-        result = self.read_result()
+        result = self.query(XDM1041Cmd.FUNC2)
         return result
 
     def read_val1_raw(self):
         """
         Read the raw value for measurement 1
         """
-        cmd = str(XDM1041Cmd.MEASURE_1_RAW)
-        self.send_cmd(cmd)
-        val_str = self.read_result()
+        val_str = self.query(XDM1041Cmd.MEASURE_1_RAW)
         ret_float = float(val_str)
         return ret_float
 
@@ -172,9 +327,7 @@ class XDM1041(Equipment):
         """
         Read the raw value for measurement 2
         """
-        cmd = str(XDM1041Cmd.MEASURE_2_RAW)
-        self.send_cmd(cmd)
-        val_str = self.read_result()
+        val_str = self.query(XDM1041Cmd.MEASURE_2_RAW)
         ret_float = float(val_str)
         return ret_float
 
@@ -182,82 +335,115 @@ class XDM1041(Equipment):
         """
         Read the value for measurement 1 (includes units)
         """
-        cmd = str(XDM1041Cmd.MEASURE_1)
-        self.send_cmd(cmd)
-        val_str = self.read_result()
+        val_str = self.query(XDM1041Cmd.MEASURE_1)
         return val_str
 
     def read_val2_str(self):
         """
         Read the value for measurement 2 (includes units)
         """
-        cmd = str(XDM1041Cmd.MEASURE_2)
-        self.send_cmd(cmd)
-        val_str = self.read_result()
+        val_str = self.query(XDM1041Cmd.MEASURE_2)
         return val_str
 
-    def set_mode(self, mode: XDM1041Mode):
-        cmd = str(mode)
+    def set_mode(self, mode: XDM1041Mode, force=False) -> bool:
+        """
+        Switch the measurement mode, returns False if the meter was already in that mode
+        """
+        if not force and mode == self.mode:
+            return False
+        cmd = MODE_BYTES[mode]
         self.send_cmd(cmd)
+        # range after a mode change depends on the meter, treat it as unknown
+        self.mode = mode
+        self.range = None
+        self.auto_range = None
+        return True
 
     def set_mode_dcv(self):
         self.set_mode(XDM1041Mode.MODE_VOLTAGE_DC)
 
-    def set_sample_speed_slow(self):
-        cmd = str(XDM1041Cmd.RATE_S)
+    def _set_rate(self, rate: XDM1041Cmd, force=False):
+        if not force and self.rate == rate:
+            return
+        cmd = CMD_BYTES[rate]
         self.send_cmd(cmd)
-        time.sleep(0.2)
+        self.sync()
+        self.rate = rate
 
-    def set_sample_speed_med(self):
-        cmd = str(XDM1041Cmd.RATE_M)
-        self.send_cmd(cmd)
-        time.sleep(0.2)
+    def set_sample_speed_slow(self, force=False):
+        self._set_rate(XDM1041Cmd.RATE_S, force)
 
-    def set_sample_speed_fast(self):
-        cmd = str(XDM1041Cmd.RATE_F)
-        self.send_cmd(cmd)
-        time.sleep(0.2)
+    def set_sample_speed_med(self, force=False):
+        self._set_rate(XDM1041Cmd.RATE_M, force)
+
+    def set_sample_speed_fast(self, force=False):
+        self._set_rate(XDM1041Cmd.RATE_F, force)
+
+    def stream(self, capacity=65536, fast=True) -> XDM1041Stream:
+        """
+        Start continuous acquisition of measurement 1. The meter is switched to fast rate
+        and a background thread queries MEAS1? back to back into a ring buffer.
+        Use the returned stream's read_block(n) / samples() and stop() it when done.
+        """
+        if fast:
+            self.set_sample_speed_fast()
+        return XDM1041Stream(self, capacity).start()
 
     def set_calc_avg(self):
         """
         Set the CALC function to averaging mode
         """
-        cmd = str(XDM1041Cmd.SET_CALC_FUNC_AVG)
+        cmd = CMD_BYTES[XDM1041Cmd.SET_CALC_FUNC_AVG]
         self.send_cmd(cmd)
-        time.sleep(0.2)
+        self.sync()
 
     def get_calc_avg(self):
         """Get the calculated average"""
-        cmd = str(XDM1041Cmd.GET_CALC_AVG)
-        self.send_cmd(cmd)
-        time.sleep(0.05)
-        result = self.read_result()
+        result = self.query(XDM1041Cmd.GET_CALC_AVG)
         result = float(result)
         return result
 
     def get_calc_min(self):
         """Get the calculated minimum"""
-        cmd = str(XDM1041Cmd.GET_CALC_MIN)
-        self.send_cmd(cmd)
-        time.sleep(0.05)
-        result = self.read_result()
+        result = self.query(XDM1041Cmd.GET_CALC_MIN)
         result = float(result)
         return result
 
     def get_calc_max(self):
         """Get the calculated maximum"""
-        cmd = str(XDM1041Cmd.GET_CALC_MAX)
-        self.send_cmd(cmd)
-        time.sleep(0.05)
-        result = self.read_result()
+        result = self.query(XDM1041Cmd.GET_CALC_MAX)
         result = float(result)
         return result
 
-    def read_voltage(self):
-        self.set_mode(XDM1041Mode.MODE_VOLTAGE_DC)
-        time.sleep(4) # sleep 2 seconds or else will read 00.000 mV
-        raw_str = self.read_val1_str()
-        print(f"DMM: raw_str: {raw_str}")
-        voltage = xdm1041helper.parse_voltage_str(raw_str)
-        return voltage
+    def update_period(self):
+        """
+        Display update period for the current sample rate, the slow rate's if it is unknown
+        """
+        return self.rate_period.get(self.rate, self.rate_period[XDM1041Cmd.RATE_S])
+
+    def wait_settled(self, criterion=None, timeout=5.0, discard=0, poll_interval=None):
+        """
+        Poll measurement 1 until it meets the settle criterion (default: 3 readings within
+        tolerance, see xdm1041settle) or timeout. The result is also kept in self.last_settle
+        Polls are spaced by the update period (poll_interval overrides it) so every reading is a
+        new conversion, back to back polls would see the old value "settle" right after a step
+        """
+        if poll_interval is None:
+            poll_interval = self.update_period()
+        result = xdm1041settle.settle(
+            lambda: self.query(XDM1041Cmd.MEASURE_1_RAW),
+            criterion,
+            timeout,
+            poll_interval=poll_interval,
+            discard=discard)
+        self.last_settle = result
+        if not result.settled:
+            self.logger.warning("Reading did not settle within {}s (last value:{})".format(timeout, result.value))
+        return result
 
+    def read_voltage(self, criterion=None, timeout=4.0):
+        changed = self.set_mode(XDM1041Mode.MODE_VOLTAGE_DC)
+        # first reading after a mode change can still be 00.000 mV, throw it away
+        result = self.wait_settled(criterion, timeout, discard=1 if changed else 0)
+        print(f"DMM: settled to {result.value} in {result.elapsed:.3f}s")
+        return result.value
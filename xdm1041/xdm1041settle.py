@@ -0,0 +1,91 @@
+"""
+@file     xdm1041settle.py
+@author   Anders Bandt
+@brief    Wait for a reading to settle instead of sleeping a fixed time
+"""
+
+# import modules
+import collections
+import math
+import time
+
+
+SettleResult = collections.namedtuple("SettleResult", ["value", "settled", "elapsed", "samples"])
+
+
+class StableWindow:
+    """
+    Settled once the last n readings all lie within a band of
+    max(abs_tol, rel_tol * |mean|)
+    """
+
+    def __init__(self, n=3, abs_tol=1e-4, rel_tol=1e-3):
+        self.n = n
+        self.abs_tol = abs_tol
+        self.rel_tol = rel_tol
+
+    def __call__(self, times, values) -> bool:
+        if len(values) < self.n:
+            return False
+        window = values[-self.n:]
+        mean = sum(window) / self.n
+        return max(window) - min(window) <= max(self.abs_tol, self.rel_tol * abs(mean))
+
+
+class SlopeBelow:
+    """
+    Settled once the least squares slope over the last n readings is below
+    threshold (units per second)
+    """
+
+    def __init__(self, threshold, n=5):
+        self.threshold = threshold
+        self.n = n
+
+    def __call__(self, times, values) -> bool:
+        if len(values) < self.n:
+            return False
+        t = times[-self.n:]
+        v = values[-self.n:]
+        t_mean = sum(t) / self.n
+        v_mean = sum(v) / self.n
+        den = sum((ti - t_mean) ** 2 for ti in t)
+        if den == 0:
+            return False
+        slope = sum((ti - t_mean) * (vi - v_mean) for ti, vi in zip(t, v)) / den
+        return abs(slope) < self.threshold
+
+
+def settle(read_fn, criterion=None, timeout=5.0, poll_interval=0.0, discard=0) -> SettleResult:
+    """
+    Poll read_fn() until criterion(times, values) is met or timeout seconds passed.
+    The first `discard` readings are thrown away (e.g. stale values right after a mode change),
+    readings that fail to parse are skipped. Returns the last reading, whether the criterion
+    was met, how long it took and how many readings were used.
+    """
+    if criterion is None:
+        criterion = StableWindow()
+    t_start = time.monotonic()
+    deadline = t_start + timeout
+    times = []
+    values = []
+    value = None
+    while True:
+        try:
+            value = float(read_fn())
+        except (TypeError, ValueError):
+            value = None
+        now = time.monotonic()
+        if value is not None and not math.isnan(value):
+            if discard > 0:
+                discard -= 1
+            else:
+                times.append(now)
+                values.append(value)
+                if criterion(times, values):
+                    return SettleResult(value, True, now - t_start, len(values))
+        if now >= deadline:
+            last = values[-1] if values else value
+            return SettleResult(last, False, now - t_start, len(values))
+        if poll_interval > 0:
+            time.sleep(poll_interval)
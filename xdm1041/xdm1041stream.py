@@ -0,0 +1,162 @@
+"""
+@file     xdm1041stream.py
+@author   Anders Bandt
+@brief    Continuous acquisition of the XDM1041 primary measurement into a ring buffer
+"""
+
+# import modules
+import threading
+import time
+import numpy as np
+
+# import user created modules
+from EEequipment.xdm1041.xdm1041defs import XDM1041Cmd
+
+
+SAMPLE_DTYPE = np.dtype([("t", np.float64), ("value", np.float64)])
+
+
+class XDM1041Stream:
+    """
+    Background reader that issues MEAS1? back to back and stores (t, value) samples
+    in a preallocated ring buffer. t is time.monotonic() taken when the reply arrived,
+    unparseable replies are stored as NaN.
+
+    If the consumer falls more than `capacity` samples behind, the oldest unread samples
+    are overwritten and counted in `overruns`.
+    """
+
+    def __init__(self, xdm, capacity=65536):
+        self.xdm = xdm
+        self.capacity = capacity
+        self._buf = np.empty(capacity, dtype=SAMPLE_DTYPE)
+        self._written = 0  # total samples written since start
+        self._read = 0  # total samples handed to the consumer
+        self._cond = threading.Condition()
+        self._stop = threading.Event()
+        self._thread = None
+        self.overruns = 0
+        self.errors = 0
+        self.t_start = None
+        self.no_port_backoff = 0.5  # s between retries while the meter has no port
+
+    def start(self):
+        if self._thread is not None:
+            return self
+        if not self.xdm.status:
+            raise RuntimeError("XDM1041 serial port is not open, nothing to stream from")
+        self._stop.clear()
+        self.t_start = time.monotonic()
+        self._thread = threading.Thread(target=self._run, name="XDM1041Stream", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        with self._cond:
+            self._cond.notify_all()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    @property
+    def sample_count(self) -> int:
+        return self._written
+
+    @property
+    def sample_rate(self) -> float:
+        """
+        Achieved sample rate in Hz since the stream was started
+        """
+        if self.t_start is None or self._written == 0:
+            return 0.0
+        with self._cond:
+            n = self._written
+            t_last = self._buf[(n - 1) % self.capacity]["t"]
+        elapsed = t_last - self.t_start
+        return n / elapsed if elapsed > 0 else 0.0
+
+    def _run(self):
+        xdm = self.xdm
+        cmd = XDM1041Cmd.MEASURE_1_RAW
+        buf = self._buf
+        cap = self.capacity
+        while not self._stop.is_set():
+            val_str = xdm.query(cmd)
+            if val_str is None:
+                # the port went away (query only returns None without one), don't spin on it
+                self.errors += 1
+                self._stop.wait(self.no_port_backoff)
+                continue
+            t = time.monotonic()
+            try:
+                val = float(val_str)
+            except (TypeError, ValueError):
+                val = np.nan
+                self.errors += 1
+            with self._cond:
+                buf[self._written % cap] = (t, val)
+                self._written += 1
+                if self._written - self._read > cap:
+                    self.overruns += self._written - self._read - cap
+                    self._read = self._written - cap
+                self._cond.notify_all()
+
+    def _take(self, n):
+        # caller holds the condition; copy n unread samples out of the ring
+        start = self._read % self.capacity
+        end = start + n
+        if end <= self.capacity:
+            out = self._buf[start:end].copy()
+        else:
+            out = np.concatenate((self._buf[start:], self._buf[:end - self.capacity]))
+        self._read += n
+        return out
+
+    def available(self) -> int:
+        with self._cond:
+            return self._written - self._read
+
+    def read_block(self, n, timeout=None):
+        """
+        Block until n unread samples are available and return them as a structured array
+        with fields 't' and 'value'. On timeout (or if the stream stops) whatever is
+        available is returned, which may be fewer than n samples.
+        """
+        n = min(n, self.capacity)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while self._written - self._read < n and self.running:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            return self._take(min(n, self._written - self._read))
+
+    def read_all(self):
+        """
+        Return every unread sample without waiting
+        """
+        with self._cond:
+            return self._take(self._written - self._read)
+
+    def samples(self, timeout=None):
+        """
+        Generator yielding (t, value) tuples as they arrive. Stops when the stream is
+        stopped or when no sample arrives within timeout.
+        """
+        while True:
+            block = self.read_block(1, timeout)
+            if len(block) == 0:
+                return
+            yield float(block["t"][0]), float(block["value"][0])
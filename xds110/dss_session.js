@@ -0,0 +1,91 @@
+// @file     dss_session.js
+// @author   Anders Bandt
+// @brief    Long lived Debug Server Scripting session for one XDS110 probe
+//
+// Started by xds110_api.LoaderSession:  dss.sh dss_session.js <target config .ccxml>
+// Connects once, then reads one command per line from stdin and answers each with exactly one
+// line starting with "OK" or "ERR" (anything else printed is log output):
+//
+//     ping                 OK pong
+//     load <file.out>      load the program (the target is halted first)
+//     verify <file.out>    compare target memory against the program
+//     reset                reset the target
+//     run                  run the target without waiting
+//     quit                 disconnect and exit
+//
+// "READY" is printed once the target is connected.
+
+importPackage(Packages.com.ti.debug.engine.scripting);
+importPackage(Packages.com.ti.ccstudio.scripting.environment);
+importPackage(Packages.java.lang);
+importPackage(Packages.java.io);
+
+var env = ScriptingEnvironment.instance();
+var stdin = new BufferedReader(new InputStreamReader(System["in"]));
+var out = System.out;
+
+function reply(line) {
+    out.println(line);
+    out.flush();
+}
+
+var server = null;
+var session = null;
+try {
+    env.traceSetConsoleLevel(TraceLevel.OFF);
+    server = env.getServer("DebugServer.1");
+    server.setConfig(arguments[0]);
+    session = server.openSession(".*");
+    session.target.connect();
+} catch (e) {
+    reply("ERR An attempt to connect to the XDS110 failed: " + e);
+    java.lang.System.exit(1);
+}
+reply("READY");
+
+var line;
+while ((line = stdin.readLine()) != null) {
+    line = String(line).trim();
+    if (line.length == 0) {
+        continue;
+    }
+    var space = line.indexOf(" ");
+    var cmd = space < 0 ? line : line.substring(0, space);
+    var arg = space < 0 ? "" : line.substring(space + 1);
+    try {
+        if (cmd == "ping") {
+            reply("OK pong");
+        } else if (cmd == "load") {
+            session.target.halt();
+            session.memory.loadProgram(arg);
+            reply("OK loaded " + arg);
+        } else if (cmd == "verify") {
+            if (session.memory.verifyProgram(arg)) {
+                reply("OK verified " + arg);
+            } else {
+                reply("ERR verify failed " + arg);
+            }
+        } else if (cmd == "reset") {
+            session.target.reset();
+            reply("OK reset");
+        } else if (cmd == "run") {
+            session.target.runAsynch();
+            reply("OK Target running");
+        } else if (cmd == "quit") {
+            reply("OK bye");
+            break;
+        } else {
+            reply("ERR unknown command " + cmd);
+        }
+    } catch (e) {
+        reply("ERR " + cmd + ": " + e);
+    }
+}
+
+try {
+    session.target.disconnect();
+    session.terminate();
+    server.stop();
+} catch (e) {
+}
+java.lang.System.exit(0);
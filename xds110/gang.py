@@ -0,0 +1,210 @@
+"""
+@file     gang.py
+@author   Anders Bandt
+@brief    Flash several targets at once, one XDS110 probe per target
+
+    gang = GangProgrammer(max_workers=4, timeout=120)
+    results = gang.flash()          # every attached probe, per-serial target configs
+    for serial, result in results.items():
+        print(serial, result.status, f"{result.elapsed:.1f}s")
+
+Each target gets its own loadti process, at most max_workers run at the same time. A target that
+runs past timeout is killed, cancel() (from another thread) kills everything still running and
+skips the targets that haven't started.
+"""
+
+# import needed modules
+import collections
+import concurrent.futures
+import os
+import re
+import subprocess
+import threading
+import time
+
+# import user defined modules
+from EEequipment.xds110 import xds110_api
+
+
+# status is one of "ok", "skipped" (image already on the target), "failed", "timeout", "cancelled", "error"
+FlashResult = collections.namedtuple(
+    "FlashResult",
+    ["serial", "status", "ok", "returncode", "elapsed", "config", "stdout", "stderr"])
+
+SERIAL_RE = re.compile(r"Serial Num:\s*(\S+)")
+CCXML_SERIAL_RE = re.compile(r'(<property\b[^>]*\bValue=")([^"]*)("[^>]*\bid="-- Enter the serial number"[^>]*>)')
+
+
+def parse_probe_serials(text):
+    '''
+    Serial numbers from `xdsdfu -e` output ("Serial Num:   L4100847" lines)
+    '''
+    return SERIAL_RE.findall(text)
+
+
+def discover_probes(timeout=10):
+    '''
+    Serial numbers of every attached XDS110
+    '''
+    if xds110_api.os_name == "Linux":
+        return [probe.serial for probe in xds110_api.get_probes()]
+    executable_path = os.path.join(xds110_api.base_tools_path, xds110_api.xds110_xds_cmd)
+    try:
+        proc = subprocess.run([executable_path, "-e"], capture_output=True, text=True, timeout=timeout)
+    except (OSError, subprocess.TimeoutExpired) as e:
+        print(f"XDS110: probe enumeration failed: {e}")
+        return []
+    return parse_probe_serials(proc.stdout)
+
+
+def target_config_for(serial_number, config_type="target_power", template_type="Any"):
+    '''
+    Path of the per-serial .ccxml, generated from the template config when it doesn't exist yet
+    (the template's "-- Enter the serial number" field is set to the probe serial)
+    '''
+    path = xds110_api.target_config_file(config_type, serial_number)
+    if os.path.exists(path) or serial_number not in path:
+        return path
+
+    template_path = xds110_api.target_config_file(template_type, serial_number)
+    with open(template_path) as f:
+        template = f.read()
+    config, count = CCXML_SERIAL_RE.subn(lambda m: m.group(1) + serial_number + m.group(3), template)
+    if count == 0:
+        raise xds110_api.XDS110Exception(
+            f"{template_path} has no debug probe serial number field, select probe by serial number "
+            f"in the CCS target configuration editor first")
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        f.write(config)
+    os.replace(tmp_path, path)
+    print(f"XDS110: generated target config {path}")
+    return path
+
+
+class GangProgrammer:
+    """
+    Bounded pool of loadti processes, one per target
+    """
+
+    def __init__(self, max_workers=4, timeout=120.0, image=None, config_type="target_power",
+                 on_line=None, on_progress=None, skip_identical=False, check_target=True):
+        self.max_workers = max_workers
+        self.timeout = timeout  # s per target
+        self.image = image  # firmware .out, default xds110_api.firmware_image
+        self.config_type = config_type
+        self.on_line = on_line  # on_line(serial, stream, line), from the worker threads
+        self.on_progress = on_progress  # on_progress(serial, stage, line)
+        self.skip_identical = skip_identical  # skip targets that already have this image
+        # ask the target before skipping (records are per probe, a swapped board would be skipped),
+        # False trusts a verified flash record alone
+        self.check_target = check_target
+        self._cancel = threading.Event()
+        self._procs = {}
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def _flash_one(self, serial):
+        t0 = time.monotonic()
+        config = None
+        if self._cancel.is_set():
+            return FlashResult(serial, "cancelled", False, None, 0.0, config, "", "")
+        image = self.image if self.image is not None else xds110_api.firmware_image
+        records = xds110_api.get_flash_records()
+        try:
+            digest = xds110_api.image_hash(image)
+        except OSError as e:
+            return FlashResult(serial, "error", False, None, time.monotonic() - t0, config, "", str(e))
+        if self.skip_identical and records.matches(serial, digest, need_verified=not self.check_target):
+            if not self.check_target:
+                print(f"XDS110 {serial}: image {digest[:12]} already flashed and verified, skipping")
+                return FlashResult(serial, "skipped", True, None, time.monotonic() - t0, config, "", "")
+            try:
+                config = target_config_for(serial, self.config_type)
+            except (OSError, xds110_api.XDS110Exception) as e:
+                return FlashResult(serial, "error", False, None, time.monotonic() - t0, config, "", str(e))
+            ok, msg = xds110_api.verify_on_target(serial, image, self.config_type)
+            if ok:
+                print(f"XDS110 {serial}: image {digest[:12]} verified on target, skipping")
+                records.record(serial, digest, image, True)
+                return FlashResult(serial, "skipped", True, None, time.monotonic() - t0, config, msg, "")
+            print(f"XDS110 {serial}: target doesn't match the record ({msg}), flashing")
+
+        def register(proc):
+            with self._lock:
+                self._procs[serial] = proc
+
+        on_line = None
+        if self.on_line is not None:
+            on_line = lambda stream, line: self.on_line(serial, stream, line)
+        on_progress = None
+        if self.on_progress is not None:
+            on_progress = lambda stage, line: self.on_progress(serial, stage, line)
+
+        try:
+            config = target_config_for(serial, self.config_type)
+            packet = xds110_api.run_streaming(
+                xds110_api.load_cmd, xds110_api.load_args(config, image),
+                on_line, on_progress, timeout=self.timeout, cancel=self._cancel, on_start=register)
+        except (OSError, xds110_api.XDS110Exception) as e:
+            return FlashResult(serial, "error", False, None, time.monotonic() - t0, config, "", str(e))
+        finally:
+            with self._lock:
+                self._procs.pop(serial, None)
+
+        elapsed = time.monotonic() - t0
+        if packet.status == "fatal":
+            status = "failed"
+        elif packet.status != "exited":
+            status = packet.status
+        elif packet.returncode == 0 and xds110_api.flash_ok(packet.stdout, packet.stderr):
+            status = "ok"
+        else:
+            status = "failed"
+        if status == "ok":
+            records.record(serial, digest, image, False)
+        else:
+            records.forget(serial)
+        print(f"XDS110 {serial}: {status} in {elapsed:.1f}s" + (f" ({packet.fatal_line})" if packet.fatal_line else ""))
+        return FlashResult(serial, status, status == "ok", packet.returncode, elapsed, config, packet.stdout, packet.stderr)
+
+    def start(self, serials=None):
+        '''
+        Start flashing, returns {serial: Future[FlashResult]}, serials default to every attached probe
+        '''
+        if serials is None:
+            serials = discover_probes()
+        self._cancel.clear()
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers,
+                                                                   thread_name_prefix="XDS110Gang")
+        return {serial: self._executor.submit(self._flash_one, serial) for serial in serials}
+
+    def flash(self, serials=None):
+        '''
+        Flash and wait, returns {serial: FlashResult}
+        '''
+        futures = self.start(serials)
+        return {serial: future.result() for serial, future in futures.items()}
+
+    def cancel(self):
+        '''
+        Kill every running loadti and skip the targets that haven't started
+        '''
+        self._cancel.set()
+        with self._lock:
+            procs = list(self._procs.values())
+        for proc in procs:
+            xds110_api.kill_process_tree(proc)
+
+    def close(self):
+        self.cancel()
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,82 @@
+"""
+@file     loader_stub.py
+@author   Anders Bandt
+@brief    Stand-in for the dss_session.js debug server session, same line protocol
+
+Lets LoaderSession / the session manager be exercised without CCS or a probe:
+
+    manager = LoaderSessionManager(command=[sys.executable, "-m", "EEequipment.xds110.loader_stub"])
+
+Behaviour is controlled by the target config argument and options:
+    a config path containing NOCONN fails the connect like a missing probe
+    --delay s         time every load / verify takes
+    --die-after n     exit without replying on the n-th command (a crashed session)
+"""
+
+# import needed modules
+import argparse
+import os
+import sys
+import time
+
+
+def reply(line):
+    sys.stdout.write(line + "\n")
+    sys.stdout.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stand-in debug server session")
+    parser.add_argument("config", help="target config (.ccxml)")
+    parser.add_argument("--delay", type=float, default=0.0)
+    parser.add_argument("--startup", type=float, default=0.0, help="simulated tool startup time")
+    parser.add_argument("--die-after", type=int, default=0)
+    args = parser.parse_args()
+
+    time.sleep(args.startup)
+    reply(f"Configuring Debug Server for specified target... ({args.config})")
+    if "NOCONN" in args.config:
+        reply("ERR An attempt to connect to the XDS110 failed")
+        return 1
+    reply("READY")
+
+    loaded = None
+    count = 0
+    for line in sys.stdin:
+        line = line.strip()
+        if not line:
+            continue
+        count += 1
+        if args.die_after and count >= args.die_after:
+            return 2
+        cmd, _, arg = line.partition(" ")
+        if cmd == "ping":
+            reply("OK pong")
+        elif cmd == "load":
+            time.sleep(args.delay)
+            if not os.path.exists(arg):
+                reply(f"ERR load: file not found {arg}")
+                continue
+            reply(f"Loading {arg}")
+            loaded = arg
+            reply(f"OK loaded {arg}")
+        elif cmd == "verify":
+            time.sleep(args.delay)
+            if loaded == arg:
+                reply(f"OK verified {arg}")
+            else:
+                reply(f"ERR verify failed {arg}")
+        elif cmd == "reset":
+            reply("OK reset")
+        elif cmd == "run":
+            reply("OK Target running")
+        elif cmd == "quit":
+            reply("OK bye")
+            return 0
+        else:
+            reply(f"ERR unknown command {cmd}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,107 @@
+"""
+@file     test_loader_session.py
+@author   Anders Bandt
+@brief    Exercise LoaderSession / LoaderSessionManager against loader_stub, no CCS or probe needed
+
+    python -m EEequipment.xds110.test_loader_session
+"""
+
+# import needed modules
+import os
+import sys
+import tempfile
+import time
+
+# import user defined modules
+from EEequipment.xds110.xds110_api import LoaderSession, LoaderSessionManager, XDS110Exception
+
+STUB = [sys.executable, "-m", "EEequipment.xds110.loader_stub"]
+
+
+def check_load_verify(image):
+    session = LoaderSession("STUB1", "stub.ccxml", command=STUB)
+    try:
+        assert session.load(image)[0], "load failed"
+        assert session.verify(image)[0], "verify failed"
+        assert session.run() == (True, "Target running")
+        assert not session.verify(image + ".other")[0], "verify of a different image passed"
+        assert session.restarts == 0
+    finally:
+        session.stop()
+    print("load/verify/run: ok")
+
+
+def check_restart(image):
+    # the stub exits without replying on its 2nd command, the session must come back by itself
+    session = LoaderSession("STUB2", "stub.ccxml", command=STUB + ["--die-after", "2"])
+    try:
+        assert session.load(image)[0], "first load failed"
+        assert session.load(image)[0], "load after the session died failed"
+        assert session.restarts == 1, f"expected 1 restart, got {session.restarts}"
+    finally:
+        session.stop()
+    print("restart of a dead session: ok")
+
+
+def check_connect_failure():
+    session = LoaderSession("STUB3", "NOCONN.ccxml", command=STUB)
+    try:
+        session.ping()
+    except XDS110Exception as e:
+        print(f"connect failure: ok ({e})")
+    else:
+        raise AssertionError("connect failure not reported")
+    assert not session.alive()
+
+
+def check_missing_executable(image):
+    manager = LoaderSessionManager(command=[os.path.join(tempfile.gettempdir(), "no_such_dir", "dss.sh")])
+    ok, msg = manager.flash("STUB4", image)
+    assert not ok and "can't start session" in msg, msg
+    manager.close_all()
+    print(f"missing executable: ok ({msg})")
+
+
+def check_timeout(image):
+    session = LoaderSession("STUB5", "stub.ccxml", command=STUB + ["--delay", "2"], cmd_timeout=0.5)
+    try:
+        session.load(image)
+    except XDS110Exception as e:
+        assert not session.alive(), "hung session left running"
+        print(f"command timeout: ok ({e})")
+    else:
+        raise AssertionError("timeout not reported")
+    finally:
+        session.stop()
+
+
+def check_reuse(image, loads=5):
+    # the point of the session: only the first load pays the startup
+    session = LoaderSession("STUB6", "stub.ccxml", command=STUB + ["--startup", "0.5"])
+    try:
+        t0 = time.monotonic()
+        session.load(image)
+        first = time.monotonic() - t0
+        t0 = time.monotonic()
+        for _ in range(loads):
+            session.load(image)
+        rest = (time.monotonic() - t0) / loads
+    finally:
+        session.stop()
+    assert rest < first, f"repeated loads ({rest:.3f}s) not faster than the first ({first:.3f}s)"
+    print(f"reuse: first load {first:.3f}s, then {rest * 1000:.1f} ms per load")
+
+
+if __name__ == "__main__":
+    with tempfile.TemporaryDirectory() as tmp:
+        image = os.path.join(tmp, "fw.out")
+        with open(image, "wb") as f:
+            f.write(b"\x7fELF stub image")
+
+        check_load_verify(image)
+        check_restart(image)
+        check_connect_failure()
+        check_missing_executable(image)
+        check_timeout(image)
+        check_reuse(image)
+    print("all loader session checks passed")
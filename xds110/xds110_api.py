@@ -6,12 +6,22 @@
 """
 
 # import needed modules
+import collections
 import os
 import platform
 import configparser
+import atexit
+import hashlib
+import json
+import queue
+import signal
+import subprocess
+import threading
+import time
 
 # import user defined modules
 from common import subprocessor as subp
+from EEequipment.xds110 import xds110_probes
 
 
 # get operating system information
@@ -37,6 +47,10 @@ xds110_jtag_cmd = config[os_name]["xds110_jtag_cmd"]
 xds110_xds_cmd = config[os_name]["xds110_xds_cmd"]
 gmake_cmd = base_ccs + config[os_name]["gmake_cmd"]
 load_cmd = base_script_path + config[os_name]["load_cmd"]
+firmware_image = base_project_path + "/Debug/WWD_prog.out"
+dss_cmd = base_script_path + config[os_name].get("dss_cmd", "bin/dss.bat" if os_name == "Windows" else "bin/dss.sh")
+flash_state_path = "./EEequipment/xds110/flash_state.json"
+dss_session_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "dss_session.js")
 
 
 class XDS110Exception(Exception):
@@ -72,7 +86,25 @@ def xds110_reset():
     pass
 
 
+# on Linux the probes are read from sysfs (see xds110_probes), created on first use
+probe_cache = None
+
+ProbePacket = collections.namedtuple("ProbePacket", ["stdout", "stderr", "probes"])
+
+
+def get_probes():
+    global probe_cache
+    if probe_cache is None:
+        probe_cache = xds110_probes.ProbeCache()
+    return probe_cache.get()
+
+
 def get_xds110_status():
+    if os_name == "Linux":
+        # same [status, packet] as the xdsdfu path, packet.stdout in xdsdfu -e format
+        probes = get_probes()
+        return [len(probes) > 0, ProbePacket(xds110_probes.format_xdsdfu(probes), "", probes)]
+
     executable_path = os.path.join(base_tools_path, xds110_xds_cmd)
 
     packet = subp.execute_command(executable_path, ["-e"])
@@ -94,7 +126,7 @@ def get_xds110_status():
 #########################
 
 
-def flash_firmware(config_type, serial_number):
+def target_config_file(config_type, serial_number):
     if config_type == "Any":
         config_file = f"/targetConfigs/CC2642R1F2.ccxml"
     elif config_type == "target_power":
@@ -106,32 +138,489 @@ def flash_firmware(config_type, serial_number):
     else:
         print(f"Trying config {config_type}")
         raise XDS110Exception("Bad target config type!")
+    return base_project_path + config_file
+
 
-    packet = subp.execute_command(
-        load_cmd,
-        [
-            "-a",
-            "-c",
-            base_project_path + config_file,
-            base_project_path + "/Debug/WWD_prog.out"
-        ])
-    error_words = [
-        "Error code",
-        "Error",
-        "An attempt to connect to the XDS110 failed"
-    ]
+def load_args(config_path, image=None):
+    # arguments for load_cmd (loadti) to load and run image with the given target config
+    return ["-a", "-c", config_path, image if image is not None else firmware_image]
 
+
+error_words = [
+    "Error code",
+    "Error",
+    "An attempt to connect to the XDS110 failed"
+]
+
+
+def flash_ok(stdout, stderr):
     # hack manual parse based on returned message content
-    if "Target running" in packet.stdout:
-        return [True, packet]
+    if "Target running" in stdout:
+        return True
 
     # return error status based on errors in stdout OR stderr
     for error_key in error_words:
-        if error_key in packet.stdout:
-            return [False, packet]
-        elif error_key in packet.stderr:
-            return [False, packet]
+        if error_key in stdout:
+            return False
+        elif error_key in stderr:
+            return False
 
-    return [True, packet]
+    return True
 
 
+#########################
+#### streaming runs #####
+#########################
+
+# output that means the run can't succeed any more, the loader is killed as soon as one shows up
+# (connect failures only: a run can print "Error code" and still end with "Target running")
+fatal_words = [
+    "An attempt to connect to the XDS110 failed",
+    "Error connecting to the target",
+]
+
+# (text in a loadti output line, progress stage reported to on_progress)
+progress_stages = [
+    ("Configuring Debug Server", "configuring"),
+    ("Connecting to target", "connecting"),
+    ("Loading", "loading"),
+    ("Target running", "running"),
+]
+
+# same stdout/stderr/returncode as the subprocessor packet, status is
+# "exited", "fatal" (killed on a fatal line, see fatal_line), "timeout" or "cancelled"
+StreamPacket = collections.namedtuple("StreamPacket", ["args", "returncode", "stdout", "stderr", "status", "fatal_line"])
+
+
+def kill_process_tree(proc):
+    '''
+    Kill a loader and everything it started (loadti is a script that starts the DSS java process,
+    killing only the script leaves java holding the probe and the output pipes)
+    '''
+    if proc.poll() is not None:
+        return
+    if os.name == "nt":
+        subprocess.run(["taskkill", "/F", "/T", "/PID", str(proc.pid)], capture_output=True)
+    else:
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+
+def _pump(stream, name, lines):
+    for line in iter(stream.readline, ''):
+        lines.put((name, line.rstrip("\r\n")))
+    stream.close()
+    lines.put((name, None))
+
+
+def run_streaming(executable, args, on_line=None, on_progress=None, fatal=None, timeout=None,
+                  cancel=None, on_start=None) -> StreamPacket:
+    '''
+    Run a command reading stdout/stderr line by line as they arrive
+    on_line(stream, line) gets every line ("stdout"/"stderr"), on_progress(stage, line) every
+    progress_stages match, the process is killed on the first line containing one of fatal
+    (default fatal_words), after timeout seconds or when the cancel Event is set
+    on_start(proc) is called right after the process starts
+    '''
+    fatal = fatal_words if fatal is None else fatal
+    cmd = [executable] + list(args)
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, bufsize=1,
+                            start_new_session=os.name != "nt")
+    if on_start is not None:
+        on_start(proc)
+
+    lines = queue.Queue()
+    for stream, name in ((proc.stdout, "stdout"), (proc.stderr, "stderr")):
+        threading.Thread(target=_pump, args=(stream, name, lines), daemon=True).start()
+
+    output = {"stdout": [], "stderr": []}
+    deadline = None if timeout is None else time.monotonic() + timeout
+    status = "exited"
+    fatal_line = None
+    open_streams = 2
+    while open_streams:
+        wait = 0.1
+        if deadline is not None:
+            wait = min(wait, max(deadline - time.monotonic(), 0))
+        try:
+            name, line = lines.get(timeout=wait)
+        except queue.Empty:
+            name, line = None, None
+        if status == "exited":
+            if cancel is not None and cancel.is_set():
+                status = "cancelled"
+                kill_process_tree(proc)
+            elif deadline is not None and time.monotonic() >= deadline:
+                status = "timeout"
+                kill_process_tree(proc)
+        if name is None:
+            continue
+        if line is None:
+            open_streams -= 1
+            continue
+
+        output[name].append(line)
+        if on_line is not None:
+            on_line(name, line)
+        if status != "exited":
+            continue
+        if on_progress is not None:
+            for text, stage in progress_stages:
+                if text in line:
+                    on_progress(stage, line)
+        if any(word in line for word in fatal):
+            status = "fatal"
+            fatal_line = line
+            kill_process_tree(proc)
+
+    proc.wait()
+    return StreamPacket(cmd, proc.returncode, "\n".join(output["stdout"]), "\n".join(output["stderr"]), status, fatal_line)
+
+
+def flash_firmware(config_type, serial_number, on_line=None, on_progress=None, timeout=None):
+    '''
+    Load and run the firmware, the loader is stopped early when it reports a fatal error
+    '''
+    packet = run_streaming(load_cmd, load_args(target_config_file(config_type, serial_number)),
+                           on_line, on_progress, timeout=timeout)
+    if packet.status != "exited":
+        return [False, packet]
+    return [flash_ok(packet.stdout, packet.stderr), packet]
+
+
+#########################
+#### loader sessions ####
+#########################
+
+
+class LoaderSession:
+    """
+    One long lived debug server process (dss_session.js) connected to one probe, so repeated
+    loads don't pay the tool/JVM startup and the probe connect every time
+    Commands go down stdin one per line, each is answered with one "OK ..."/"ERR ..." line,
+    see dss_session.js. A session that died is restarted on the next command
+    """
+
+    def __init__(self, serial_number, config_path, command=None, start_timeout=60.0, cmd_timeout=120.0, on_line=None):
+        self.serial_number = serial_number
+        self.config_path = config_path
+        self.command = command if command is not None else [dss_cmd, dss_session_script]
+        self.start_timeout = start_timeout
+        self.cmd_timeout = cmd_timeout
+        self.on_line = on_line  # on_line(line) for log output from the session
+        self.proc = None
+        self.restarts = 0
+        self._lines = None
+        self._lock = threading.Lock()
+
+    def alive(self):
+        return self.proc is not None and self.proc.poll() is None
+
+    def _pump(self, proc, lines):
+        for line in iter(proc.stdout.readline, ''):
+            lines.put(line.rstrip("\r\n"))
+        lines.put(None)
+
+    def _next_reply(self, timeout, prefixes=("OK", "ERR")):
+        # wait for a protocol line, log lines in between go to on_line
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise XDS110Exception(f"XDS110 {self.serial_number}: session did not answer within {timeout}s")
+            try:
+                line = self._lines.get(timeout=remaining)
+            except queue.Empty:
+                continue
+            if line is None:
+                raise XDS110Exception(f"XDS110 {self.serial_number}: session exited (code {self.proc.wait()})")
+            if line.startswith(prefixes):
+                return line
+            if self.on_line is not None:
+                self.on_line(line)
+
+    def start(self):
+        self.stop()
+        t0 = time.monotonic()
+        cmd = self.command + [self.config_path]
+        try:
+            self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                         text=True, bufsize=1, start_new_session=os.name != "nt")
+        except OSError as e:
+            # missing or not executable debug server script
+            raise XDS110Exception(f"XDS110 {self.serial_number}: can't start session {cmd[0]}: {e}") from e
+        self._lines = queue.Queue()
+        threading.Thread(target=self._pump, args=(self.proc, self._lines), daemon=True,
+                         name=f"LoaderSession-{self.serial_number}").start()
+        try:
+            line = self._next_reply(self.start_timeout, ("READY", "ERR"))
+        except XDS110Exception:
+            self.stop()
+            raise
+        if line.startswith("ERR"):
+            self.stop()
+            raise XDS110Exception(f"XDS110 {self.serial_number}: {line[4:]}")
+        print(f"XDS110 {self.serial_number}: session ready in {time.monotonic() - t0:.1f}s")
+
+    def request(self, line, timeout=None):
+        '''
+        Send one command, returns (ok, message). A dead session is restarted and the command
+        sent again once
+        '''
+        with self._lock:
+            for attempt in range(2):
+                if not self.alive():
+                    if self.proc is not None:
+                        print(f"XDS110 {self.serial_number}: session died, restarting")
+                        self.restarts += 1
+                    self.start()
+                try:
+                    self.proc.stdin.write(line + "\n")
+                    self.proc.stdin.flush()
+                    reply = self._next_reply(self.cmd_timeout if timeout is None else timeout)
+                except (OSError, XDS110Exception) as e:
+                    if self.alive():
+                        # still running but not answering: don't trust it any more
+                        self.stop()
+                        raise XDS110Exception(str(e))
+                    if attempt:
+                        raise XDS110Exception(str(e))
+                    continue
+                ok = reply.startswith("OK")
+                return ok, reply[3:] if ok else reply[4:]
+
+    def ping(self):
+        return self.request("ping", timeout=5.0)[0]
+
+    def load(self, image=None):
+        return self.request(f"load {image if image is not None else firmware_image}")
+
+    def verify(self, image=None):
+        return self.request(f"verify {image if image is not None else firmware_image}")
+
+    def reset(self):
+        return self.request("reset")
+
+    def run(self):
+        return self.request("run")
+
+    def stop(self):
+        proc = self.proc
+        self.proc = None
+        if proc is None:
+            return
+        if proc.poll() is None:
+            try:
+                proc.stdin.write("quit\n")
+                proc.stdin.flush()
+                proc.wait(timeout=5)
+            except (OSError, subprocess.TimeoutExpired):
+                kill_process_tree(proc)
+                proc.wait()
+        for stream in (proc.stdin, proc.stdout):
+            try:
+                stream.close()
+            except OSError:
+                pass
+
+
+class LoaderSessionManager:
+    """
+    One LoaderSession per probe serial, started on first use and kept open
+    command replaces the dss launch command (e.g. the loader_stub stand-in), config_type is the
+    default target config; asking for another one replaces the probe's session (a probe can only
+    be connected once)
+    """
+
+    def __init__(self, command=None, config_type="target_power", **session_kwargs):
+        self.command = command
+        self.config_type = config_type
+        self.session_kwargs = session_kwargs
+        self.sessions = {}
+        self._lock = threading.Lock()
+
+    def get(self, serial_number, config_type=None):
+        config_path = target_config_file(self.config_type if config_type is None else config_type, serial_number)
+        stale = None
+        with self._lock:
+            session = self.sessions.get(serial_number)
+            if session is not None and session.config_path != config_path:
+                stale, session = session, None
+            if session is None:
+                session = LoaderSession(serial_number, config_path, self.command, **self.session_kwargs)
+                self.sessions[serial_number] = session
+        if stale is not None:
+            stale.stop()
+        return session
+
+    def flash(self, serial_number, image=None, verify=False, config_type=None):
+        '''
+        load (+ verify) + run through the probe's session, returns [ok, message] like flash_firmware
+        '''
+        session = self.get(serial_number, config_type)
+        try:
+            ok, msg = session.load(image)
+            if ok and verify:
+                ok, msg = session.verify(image)
+            if ok:
+                ok, msg = session.run()
+        except XDS110Exception as e:
+            return [False, str(e)]
+        return [ok, msg]
+
+    def close(self, serial_number):
+        with self._lock:
+            session = self.sessions.pop(serial_number, None)
+        if session is not None:
+            session.stop()
+
+    def close_all(self):
+        with self._lock:
+            sessions = list(self.sessions.values())
+            self.sessions.clear()
+        for session in sessions:
+            session.stop()
+
+
+session_manager = LoaderSessionManager()
+atexit.register(session_manager.close_all)
+
+
+#########################
+#### skip identical #####
+#########################
+
+# path -> (mtime_ns, size, sha256), the image is only hashed again when it changes on disk
+_image_hashes = {}
+
+
+def image_hash(path=None):
+    path = firmware_image if path is None else path
+    st = os.stat(path)
+    cached = _image_hashes.get(path)
+    if cached is not None and cached[0] == st.st_mtime_ns and cached[1] == st.st_size:
+        return cached[2]
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    _image_hashes[path] = (st.st_mtime_ns, st.st_size, digest.hexdigest())
+    return _image_hashes[path][2]
+
+
+class FlashRecords:
+    """
+    Per probe serial: hash of the image last flashed successfully (and whether it was verified),
+    kept in a JSON file so re-tests in a later run can skip the flash
+    """
+
+    def __init__(self, path=flash_state_path):
+        self.path = path
+        self._lock = threading.Lock()
+        try:
+            with open(path) as f:
+                self.records = json.load(f)
+        except (OSError, ValueError):
+            self.records = {}
+
+    def get(self, serial_number):
+        with self._lock:
+            return self.records.get(serial_number)
+
+    def matches(self, serial_number, digest, need_verified=True):
+        record = self.get(serial_number)
+        if record is None or record["hash"] != digest:
+            return False
+        return record["verified"] or not need_verified
+
+    def record(self, serial_number, digest, image, verified):
+        with self._lock:
+            self.records[serial_number] = {"hash": digest, "image": image, "verified": verified,
+                                           "time": time.strftime("%Y-%m-%d %H:%M:%S")}
+            self._save()
+
+    def forget(self, serial_number):
+        with self._lock:
+            if self.records.pop(serial_number, None) is not None:
+                self._save()
+
+    def _save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.records, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+
+flash_records = None
+
+
+def get_flash_records():
+    global flash_records
+    if flash_records is None:
+        flash_records = FlashRecords()
+    return flash_records
+
+
+def verify_on_target(serial_number, image=None, config_type="target_power", keep_session=False):
+    '''
+    Compare the target's memory against image through the probe's debug server session,
+    returns [ok, message]. The session is closed again unless keep_session
+    '''
+    try:
+        return session_manager.get(serial_number, config_type).verify(image)
+    except XDS110Exception as e:
+        return [False, str(e)]
+    finally:
+        if not keep_session:
+            # the session holds the probe, loadti can't connect while it is open
+            session_manager.close(serial_number)
+
+
+def flash_firmware_cached(config_type, serial_number, image=None, force=False, verify=False,
+                          check_target=True, use_session=False, records=None, timeout=None, cancel=None):
+    '''
+    Flash unless the target already has this exact image (by content hash of the .out)
+    Records are kept per probe, not per board, so by default the target itself is asked before
+    skipping (memory compare through the probe's debug server session). check_target=False
+    trusts a verified record alone: only for fixtures where the board is never swapped
+    verify checks the target after flashing. Sessions opened for that are closed again unless
+    use_session is set. timeout (s) and the cancel Event apply to the loader run like in run_streaming
+    Returns [ok, packet or session message, skipped]
+    '''
+    image = firmware_image if image is None else image
+    records = get_flash_records() if records is None else records
+    digest = image_hash(image)
+
+    if not force and records.matches(serial_number, digest, need_verified=not check_target):
+        if not check_target:
+            print(f"XDS110 {serial_number}: image {digest[:12]} already flashed and verified, skipping")
+            return [True, None, True]
+        ok, msg = verify_on_target(serial_number, image, config_type, use_session)
+        if ok:
+            print(f"XDS110 {serial_number}: image {digest[:12]} verified on target, skipping")
+            records.record(serial_number, digest, image, True)
+            return [True, msg, True]
+        print(f"XDS110 {serial_number}: target doesn't match the record ({msg}), flashing")
+
+    if use_session:
+        ok, packet = session_manager.flash(serial_number, image, verify=verify, config_type=config_type)
+        verified = ok and verify
+    else:
+        packet = run_streaming(load_cmd, load_args(target_config_file(config_type, serial_number), image),
+                               timeout=timeout, cancel=cancel)
+        ok = packet.status == "exited" and flash_ok(packet.stdout, packet.stderr)
+        verified = False
+        if ok and verify:
+            verified, msg = verify_on_target(serial_number, image, config_type)
+            if not verified:
+                print(f"XDS110 {serial_number}: verify after flash failed ({msg})")
+                ok = False
+
+    if ok:
+        records.record(serial_number, digest, image, verified)
+    else:
+        # the target's content is unknown after a failed attempt
+        records.forget(serial_number)
+    return [ok, packet, False]
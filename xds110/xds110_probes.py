@@ -0,0 +1,166 @@
+"""
+@file     xds110_probes.py
+@author   Anders Bandt
+@brief    Find XDS110 probes from Linux sysfs instead of running xdsdfu -e
+
+    probes = ProbeCache()
+    probes.get()        # [XDS110Probe(serial='L4100847', bus_path='1-2', ...)]
+    probes.present()    # True if at least one probe is attached
+
+The scan reads a few small files per USB device. ProbeCache only rescans when something was
+hot plugged: a kernel uevent netlink socket marks the cache dirty on any USB add/remove, and
+where that socket can't be opened a cheap signature check (the /sys/bus/usb/devices listing
+plus the device numbers of the cached probes) is done on every call instead.
+"""
+
+# import needed modules
+import collections
+import os
+import socket
+import threading
+
+
+SYSFS_USB = "/sys/bus/usb/devices"
+XDS110_VID = "0451"
+XDS110_PIDS = ("bef3", "bef4")
+NETLINK_KOBJECT_UEVENT = 15
+
+XDS110Probe = collections.namedtuple("XDS110Probe", ["serial", "bus_path", "vid", "pid", "busnum", "devnum"])
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def scan_sysfs(root=SYSFS_USB):
+    '''
+    Every XDS110 in sysfs, sorted by bus path
+    '''
+    probes = []
+    try:
+        entries = os.listdir(root)
+    except OSError:
+        return probes
+    for name in entries:
+        if ":" in name:  # interfaces, not devices
+            continue
+        base = os.path.join(root, name)
+        if _read(os.path.join(base, "idVendor")) != XDS110_VID:
+            continue
+        pid = _read(os.path.join(base, "idProduct"))
+        if pid not in XDS110_PIDS:
+            continue
+        probes.append(XDS110Probe(
+            _read(os.path.join(base, "serial")) or "",
+            name,
+            XDS110_VID,
+            pid,
+            int(_read(os.path.join(base, "busnum")) or 0),
+            int(_read(os.path.join(base, "devnum")) or 0)))
+    return sorted(probes, key=lambda probe: probe.bus_path)
+
+
+def format_xdsdfu(probes):
+    '''
+    The probe list as `xdsdfu -e` style text, for code that parses that output
+    '''
+    lines = [f"Found {len(probes)} devices."]
+    for k, probe in enumerate(probes):
+        lines += ["", f"                     XDS110 Device {k}", f"  Serial Num:   {probe.serial}",
+                  f"  USB path:     {probe.bus_path}"]
+    return "\n".join(lines) + "\n"
+
+
+class ProbeCache:
+    """
+    Cached scan_sysfs(), see the module docstring for when it rescans
+    """
+
+    def __init__(self, root=SYSFS_USB, watch=True):
+        self.root = root
+        self.scans = 0
+        self._probes = None
+        self._signature = None
+        self._dirty = threading.Event()
+        self._lock = threading.Lock()
+        self._sock = None
+        self._thread = None
+        if watch:
+            self._start_watcher()
+
+    @property
+    def watching(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def _start_watcher(self):
+        try:
+            sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_KOBJECT_UEVENT)
+            sock.bind((0, 1))  # group 1: kernel uevents
+        except (AttributeError, OSError) as e:
+            print(f"XDS110: no uevent socket ({e}), checking sysfs on every call")
+            return
+        self._sock = sock
+        self._thread = threading.Thread(target=self._watch, name="XDS110ProbeWatch", daemon=True)
+        self._thread.start()
+
+    def _watch(self):
+        while True:
+            try:
+                msg = self._sock.recv(8192)
+            except OSError:
+                # socket closed (stop) or broken, fall back to the signature check
+                self._dirty.set()
+                return
+            if b"SUBSYSTEM=usb\x00" in msg:
+                self._dirty.set()
+
+    def _current_signature(self, probes):
+        try:
+            names = tuple(sorted(name for name in os.listdir(self.root) if ":" not in name))
+        except OSError:
+            names = ()
+        # a different device in the same port keeps the name but gets a new device number
+        devnums = tuple(_read(os.path.join(self.root, probe.bus_path, "devnum")) for probe in probes or ())
+        return names, devnums
+
+    def invalidate(self):
+        self._dirty.set()
+
+    def get(self):
+        '''
+        Attached probes, from the cache unless something changed
+        '''
+        with self._lock:
+            if self._probes is not None and not self._dirty.is_set():
+                if self.watching:
+                    return list(self._probes)
+                if self._current_signature(self._probes) == self._signature:
+                    return list(self._probes)
+            self._dirty.clear()
+            self._probes = scan_sysfs(self.root)
+            self.scans += 1
+            if not self.watching:
+                self._signature = self._current_signature(self._probes)
+            return list(self._probes)
+
+    def present(self):
+        return len(self.get()) > 0
+
+    def serials(self):
+        return [probe.serial for probe in self.get()]
+
+    def stop(self):
+        if self._sock is not None:
+            try:
+                self._sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self._sock.close()
+            self._sock = None
+        if self._thread is not None:
+            self._thread.join(timeout=1.0)
+            self._thread = None